@@ -0,0 +1,365 @@
+import datetime
+import numpy as np
+
+from bson.binary import Binary
+from archive_index import IMAGE_SETS
+from db import get_db
+from helpers import get_class_names, get_dataset_info, query_cache
+from metrics import timed_query
+from settings import setting
+
+ANALYTICS_BATCH_SIZE = setting('analytics_batch_size', 5000)
+# class pairs per co-occurrence document, 16 bytes each, which keeps documents well under the 16 MB limit
+COOCCURRENCE_CHUNK_SIZE = 500000
+
+# bins of normalized box width and height, and of box area (as a share of the image, finer for small boxes)
+SIZE_BINS = np.linspace(0, 1, 21)
+AREA_BINS = np.array([0, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1])
+# images with more objects than this share the last bin of the objects per image distribution
+MAX_OBJECTS_BIN = 100
+
+def encode_array(array):
+    """Packs a NumPy array into an analytics document field"""
+
+    array = np.ascontiguousarray(array)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape), 'data': Binary(array.tobytes())}
+
+def decode_array(field):
+    """Unpacks an array packed by encode_array()"""
+
+    return np.frombuffer(field['data'], dtype=np.dtype(field['dtype'])).reshape(field['shape'])
+
+def row_ranges(starts, lengths):
+    """Gets the indexes of all values of the given rows, row by row"""
+
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1] if len(ends) else 0)
+
+def box_sizes(task, values, offsets):
+    """Gets the normalized width and height of every label row in one vectorized pass
+
+    Detect and pose rows start with x, y, w, h; polygon rows (segment, obb and detect polygons) get
+    the extent of their points; classify rows have no box and get NaN"""
+
+    starts = offsets[:-1].astype(np.int64)
+    lengths = np.diff(offsets).astype(np.int64)
+    (widths, heights) = (np.full(len(starts), np.nan, dtype=np.float32), np.full(len(starts), np.nan, dtype=np.float32))
+
+    is_box = (lengths == 4) if task == 'detect' else np.full(len(starts), task == 'pose')
+    is_box &= lengths >= 4
+    widths[is_box] = values[starts[is_box] + 2]
+    heights[is_box] = values[starts[is_box] + 3]
+
+    is_polygon = ~is_box & (lengths >= 6) & (lengths % 2 == 0)
+    if is_polygon.any():
+        points = values[row_ranges(starts[is_polygon], lengths[is_polygon])]
+        (xs, ys) = (points[0::2], points[1::2])
+        point_starts = (np.cumsum(lengths[is_polygon]) - lengths[is_polygon]) // 2
+        widths[is_polygon] = np.maximum.reduceat(xs, point_starts) - np.minimum.reduceat(xs, point_starts)
+        heights[is_polygon] = np.maximum.reduceat(ys, point_starts) - np.minimum.reduceat(ys, point_starts)
+
+    return widths, heights
+
+def class_histogram(class_index, values, bins, class_count):
+    """Counts values per class in bins, gets a class_count x (len(bins) - 1) array"""
+
+    known = ~np.isnan(values)
+    bin_index = np.clip(np.searchsorted(bins, values[known], side='right') - 1, 0, len(bins) - 2)
+    counts = np.bincount(class_index[known] * (len(bins) - 1) + bin_index, minlength=class_count * (len(bins) - 1))
+    return counts.reshape(class_count, len(bins) - 1)
+
+class SplitAnalytics:
+    """Accumulates the label analytics of one image set batch by batch"""
+
+    def __init__(self, task, class_ids):
+        self.task = task
+        self.class_ids = class_ids
+        count = len(class_ids)
+        self.labelled_images = 0
+        self.label_counts = np.zeros(count, dtype=np.int64)
+        self.width_histogram = np.zeros((count, len(SIZE_BINS) - 1), dtype=np.int64)
+        self.height_histogram = np.zeros((count, len(SIZE_BINS) - 1), dtype=np.int64)
+        self.area_histogram = np.zeros((count, len(AREA_BINS) - 1), dtype=np.int64)
+        self.objects_per_image = np.zeros(MAX_OBJECTS_BIN + 1, dtype=np.int64)
+        # co-occurring class index pairs (row <= column) as row * classes + column codes, sorted, with their image counts
+        self.pair_codes = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros(0, dtype=np.int64)
+
+    def class_index(self, class_ids):
+        """Maps class ids to positions in class_ids, ids without a class name get -1"""
+
+        if len(self.class_ids) == 0:
+            return np.full(len(class_ids), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.class_ids, class_ids), len(self.class_ids) - 1)
+        return np.where(self.class_ids[index] == class_ids, index, -1)
+
+    def add(self, label_docs):
+        """Adds a batch of dataset_labels documents, concatenating their packed arrays"""
+
+        if not label_docs:
+            return
+        classes = np.concatenate([np.frombuffer(doc['classes'], dtype=np.uint16) for doc in label_docs]).astype(np.int64)
+        values = np.concatenate([np.frombuffer(doc['coordinates'], dtype=np.float32) for doc in label_docs])
+        # offsets of every document start at 0, shift them by the values of the documents before it
+        row_counts = np.array([doc['label_count'] for doc in label_docs], dtype=np.int64)
+        value_counts = np.array([len(doc['coordinates']) // 4 for doc in label_docs], dtype=np.int64)
+        offsets = np.concatenate([np.frombuffer(doc['offsets'], dtype=np.uint32)[:-1] for doc in label_docs]).astype(np.int64)
+        offsets += np.repeat(np.cumsum(value_counts) - value_counts, row_counts)
+        offsets = np.append(offsets, len(values))
+
+        class_index = self.class_index(classes)
+        known = class_index >= 0
+        self.labelled_images += len(label_docs)
+        self.label_counts += np.bincount(class_index[known], minlength=len(self.class_ids))
+        self.objects_per_image += np.bincount(np.minimum(row_counts, MAX_OBJECTS_BIN), minlength=MAX_OBJECTS_BIN + 1)
+
+        if self.task != 'classify':
+            (widths, heights) = box_sizes(self.task, values, offsets)
+            (index, widths, heights) = (class_index[known], widths[known], heights[known])
+            self.width_histogram += class_histogram(index, widths, SIZE_BINS, len(self.class_ids))
+            self.height_histogram += class_histogram(index, heights, SIZE_BINS, len(self.class_ids))
+            self.area_histogram += class_histogram(index, widths * heights, AREA_BINS, len(self.class_ids))
+
+        # every pair of distinct classes of an image (and the class with itself) is counted once
+        doc_class_ids = [doc['class_ids'] for doc in label_docs]
+        doc_index = np.repeat(np.arange(len(label_docs)), [len(ids) for ids in doc_class_ids])
+        distinct_index = self.class_index(np.array([class_id for ids in doc_class_ids for class_id in ids], dtype=np.int64))
+        (doc_index, distinct_index) = (doc_index[distinct_index >= 0], distinct_index[distinct_index >= 0])
+        image_lengths = np.bincount(doc_index, minlength=len(label_docs))
+        (starts, lengths) = ((np.cumsum(image_lengths) - image_lengths)[doc_index], image_lengths[doc_index])
+        (rows, columns) = (np.repeat(distinct_index, lengths), distinct_index[row_ranges(starts, lengths)])
+        upper = rows <= columns
+        (codes, counts) = np.unique(rows[upper] * len(self.class_ids) + columns[upper], return_counts=True)
+        self.add_pairs(codes, counts)
+
+    def add_pairs(self, codes, counts):
+        """Merges sorted pair codes with their counts into the pairs counted so far"""
+
+        (self.pair_codes, index) = np.unique(np.concatenate((self.pair_codes, codes)), return_inverse=True)
+        pair_counts = np.zeros(len(self.pair_codes), dtype=np.int64)
+        np.add.at(pair_counts, index, np.concatenate((self.pair_counts, counts)))
+        self.pair_counts = pair_counts
+
+    def result(self, images):
+        """Gets the analytics fields of the image set, images is its number of images (labelled or not)"""
+
+        objects_per_image = self.objects_per_image.copy()
+        objects_per_image[0] += max(images - self.labelled_images, 0)
+        return {
+            'images': images,
+            'labelled_images': self.labelled_images,
+            'labels': int(self.label_counts.sum()),
+            'label_counts': encode_array(self.label_counts),
+            'width_histogram': encode_array(self.width_histogram),
+            'height_histogram': encode_array(self.height_histogram),
+            'area_histogram': encode_array(self.area_histogram),
+            'objects_per_image': encode_array(objects_per_image),
+        }
+
+    def cooccurrence_docs(self, dataset_id, image_set):
+        """Gets the co-occurrence documents of the image set, the non-zero upper triangle of the matrix in chunks"""
+
+        (rows, columns) = np.divmod(self.pair_codes, max(len(self.class_ids), 1))
+        counts = self.pair_counts
+        docs = []
+        for start in range(0, len(counts), COOCCURRENCE_CHUNK_SIZE):
+            end = start + COOCCURRENCE_CHUNK_SIZE
+            docs.append({
+                'dataset_id': dataset_id,
+                'image_set': image_set,
+                'start': start,
+                'rows': encode_array(rows[start:end].astype(np.int32)),
+                'columns': encode_array(columns[start:end].astype(np.int32)),
+                'counts': encode_array(counts[start:end]),
+            })
+        return docs
+
+def label_batches(dataset_id, image_set, batch_size=ANALYTICS_BATCH_SIZE):
+    """Yields the packed label documents of an image set in batches, read with one cursor"""
+
+    cursor = get_db()['dataset_labels'].find(
+        {'dataset_id': dataset_id, 'image_set': image_set},
+        {'_id': 0, 'class_ids': 1, 'label_count': 1, 'classes': 1, 'coordinates': 1, 'offsets': 1},
+        batch_size=batch_size,
+    )
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def compute_analytics(dataset_id):
+    """Computes the label analytics of every image set of a dataset and stores them in dataset_analytics"""
+
+    dataset = get_dataset_info(dataset_id)
+    task = dataset.get('task', 'detect')
+    class_names = get_class_names(dataset_id)
+    class_ids = np.array(sorted(class_names), dtype=np.int64)
+    image_set_stats = dataset.get('stats', {}).get('image_sets', {})
+
+    analytics = {
+        'dataset_id': dataset_id,
+        'task': task,
+        'class_ids': class_ids.tolist(),
+        'size_bins': SIZE_BINS.tolist(),
+        'area_bins': AREA_BINS.tolist(),
+        'image_sets': {},
+        'computed_time': datetime.datetime.now(datetime.UTC),
+    }
+    cooccurrence_docs = []
+    for image_set in IMAGE_SETS:
+        split = SplitAnalytics(task, class_ids)
+        for batch in label_batches(dataset_id, image_set):
+            split.add(batch)
+        images = image_set_stats.get(image_set, {}).get('images', split.labelled_images)
+        if images > 0:
+            analytics['image_sets'][image_set] = split.result(images)
+            cooccurrence_docs.extend(split.cooccurrence_docs(dataset_id, image_set))
+
+    db = get_db()
+    db['dataset_cooccurrence'].delete_many({'dataset_id': dataset_id})
+    if cooccurrence_docs:
+        db['dataset_cooccurrence'].insert_many(cooccurrence_docs)
+    db['dataset_analytics'].replace_one({'dataset_id': dataset_id}, analytics, upsert=True)
+    query_cache.invalidate_prefix((dataset_id, 'analytics'))
+
+    return analytics
+
+@timed_query
+def get_analytics(dataset_id):
+    """Gets the stored label analytics of an ingested dataset, None while they have not been computed"""
+
+    analytics = query_cache.get((dataset_id, 'analytics'))
+    if analytics is None:
+        analytics = get_db()['dataset_analytics'].find_one({'dataset_id': dataset_id}, {'_id': 0})
+        if analytics is None:
+            return None
+        query_cache.set((dataset_id, 'analytics'), analytics)
+
+    return analytics
+
+@timed_query
+def get_cooccurrence(dataset_id, image_set):
+    """Gets the class co-occurrence of an image set as (rows, columns, counts) arrays of the upper triangle"""
+
+    (rows, columns, counts) = ([], [], [])
+    for doc in get_db()['dataset_cooccurrence'].find({'dataset_id': dataset_id, 'image_set': image_set}, {'_id': 0, 'rows': 1, 'columns': 1, 'counts': 1}).sort('start', 1):
+        rows.append(decode_array(doc['rows']))
+        columns.append(decode_array(doc['columns']))
+        counts.append(decode_array(doc['counts']))
+    if not counts:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(counts)
+
+def build_cooccurrence(class_ids, class_names, label_counts, cooccurrence, top_classes=None):
+    """Gets the co-occurrence of an image set as [class id, class id, images] triplets (first id <= second id)
+
+    With top_classes, gets the table of the classes with the most labels instead, as these classes
+    and a matrix of counts"""
+
+    (rows, columns, counts) = cooccurrence
+    class_ids = np.asarray(class_ids, dtype=np.int64)
+    if top_classes is None:
+        return {'class_pairs': np.stack((class_ids[rows], class_ids[columns], counts), axis=1).tolist()}
+
+    shown = np.argsort(-np.asarray(label_counts), kind='stable')[:top_classes]
+    position = np.full(len(class_ids), -1, dtype=np.int64)
+    position[shown] = np.arange(len(shown))
+    keep = (position[rows] >= 0) & (position[columns] >= 0)
+    (table_rows, table_columns) = (position[rows[keep]], position[columns[keep]])
+    table = np.zeros((len(shown), len(shown)), dtype=np.int64)
+    table[table_rows, table_columns] = counts[keep]
+    table[table_columns, table_rows] = counts[keep]
+    classes = [{'class_id': class_id, 'class_name': class_names.get(class_id, str(class_id))} for class_id in class_ids[shown].tolist()]
+    return {'classes': classes, 'counts': table.tolist()}
+
+def percentile_of_counts(counts, q):
+    """Gets the q-th percentile of values given as counts per value (nearest rank)"""
+
+    total = counts.sum()
+    if total == 0:
+        return 0
+    return int(np.searchsorted(np.cumsum(counts), max(np.ceil(q / 100 * total), 1)))
+
+def build_split_analytics(analytics, image_set, class_names, cooccurrence, top_classes=None):
+    """Unpacks the analytics of one image set and its co-occurrence into lists, keyed by class name where they are per class"""
+
+    split = analytics['image_sets'].get(image_set)
+    if split is None:
+        return None
+    objects_per_image = decode_array(split['objects_per_image'])
+    (label_counts, width_histogram, height_histogram, area_histogram) = [decode_array(split[field]).tolist() for field in ['label_counts', 'width_histogram', 'height_histogram', 'area_histogram']]
+    classes = []
+    for i, class_id in enumerate(analytics['class_ids']):
+        classes.append({
+            'class_id': class_id,
+            'class_name': class_names.get(class_id, str(class_id)),
+            'labels': label_counts[i],
+            'width_histogram': width_histogram[i],
+            'height_histogram': height_histogram[i],
+            'area_histogram': area_histogram[i],
+        })
+    return {
+        'images': split['images'],
+        'labelled_images': split['labelled_images'],
+        'labels': split['labels'],
+        'size_bins': analytics['size_bins'],
+        'area_bins': analytics['area_bins'],
+        'classes': classes,
+        'objects_per_image': {
+            'counts': objects_per_image.tolist(),
+            'last_bin_and_more': MAX_OBJECTS_BIN,
+            'mean': round(split['labels'] / split['images'], 3) if split['images'] else 0.0,
+            'p50': percentile_of_counts(objects_per_image, 50),
+            'p99': percentile_of_counts(objects_per_image, 99),
+        },
+        'cooccurrence': build_cooccurrence(analytics['class_ids'], class_names, label_counts, cooccurrence, top_classes),
+    }
+
+def build_split_balance(analytics, class_names):
+    """Gets the images and labels of every image set, overall and per class, with their share of the dataset"""
+
+    image_sets = [image_set for image_set in IMAGE_SETS if image_set in analytics['image_sets']]
+    splits = analytics['image_sets']
+    total_images = sum(splits[image_set]['images'] for image_set in image_sets)
+    total_labels = sum(splits[image_set]['labels'] for image_set in image_sets)
+    label_counts = np.array([decode_array(splits[image_set]['label_counts']) for image_set in image_sets]).reshape(len(image_sets), len(analytics['class_ids']))
+    class_totals = label_counts.sum(axis=0)
+    shares = np.divide(label_counts, class_totals, out=np.zeros(label_counts.shape), where=class_totals > 0)
+
+    balance = {'image_sets': {}, 'classes': []}
+    for i, image_set in enumerate(image_sets):
+        balance['image_sets'][image_set] = {
+            'images': splits[image_set]['images'],
+            'labels': splits[image_set]['labels'],
+            'image_share': round(splits[image_set]['images'] / total_images, 4) if total_images else 0.0,
+            'label_share': round(splits[image_set]['labels'] / total_labels, 4) if total_labels else 0.0,
+        }
+    for j, class_id in enumerate(analytics['class_ids']):
+        balance['classes'].append({
+            'class_id': class_id,
+            'class_name': class_names.get(class_id, str(class_id)),
+            'labels': {image_set: int(label_counts[i, j]) for i, image_set in enumerate(image_sets)},
+            'label_share': {image_set: round(float(shares[i, j]), 4) for i, image_set in enumerate(image_sets)},
+        })
+    return balance
+
+def get_dataset_analytics(dataset_id, image_set, top_classes=None):
+    """Gets the analytics of one image set of a dataset together with the balance of its image sets, None while they are pending
+
+    The co-occurrence is given as class pairs, or as the table of the top_classes classes with the most labels"""
+
+    analytics = get_analytics(dataset_id)
+    if analytics is None:
+        return None
+    class_names = get_class_names(dataset_id)
+    cooccurrence = get_cooccurrence(dataset_id, image_set)
+    return {
+        'image_set': image_set,
+        'analytics': build_split_analytics(analytics, image_set, class_names, cooccurrence, top_classes),
+        'split_balance': build_split_balance(analytics, class_names),
+        'computed_time': analytics['computed_time'].isoformat(),
+    }
@@ -0,0 +1,86 @@
+from collections import namedtuple
+
+IMAGE_SETS = ['train', 'val', 'test']
+
+# one image in the archive; label_member is None when the image has no label file,
+# class_name is only set for classify archives where the class comes from the directory
+ArchiveImage = namedtuple('ArchiveImage', ['image_set', 'image_name', 'member', 'label_member', 'class_name', 'size'])
+
+def label_file_name(image_name):
+    """Gets the name of the label file for an image (image extension replaced by .txt)"""
+
+    label_filename = '.'.join(image_name.split('.')[:-1]) + '.txt'
+    if label_filename == '.txt':
+        label_filename = image_name + '.txt'
+    return label_filename
+
+class ArchiveIndex:
+    """Index of the files in a zip archive, built in one pass over its central directory"""
+
+    def __init__(self, archive):
+        self.files = {}
+        self.yaml_files = []
+        self.images = {image_set: [] for image_set in IMAGE_SETS}
+        self.class_names = []
+
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            self.files[info.filename] = info
+            if info.filename[-5:] == ".yaml":
+                self.yaml_files.append(info.filename)
+
+    def index_detect(self, image_paths, label_paths):
+        """Buckets the files under each image set path and pairs every image with its label file
+
+        image_paths and label_paths map an image set to its directory prefix inside the archive"""
+
+        for file, info in self.files.items():
+            for image_set, image_path in image_paths.items():
+                if file.startswith(image_path):
+                    image_name = file[len(image_path):]
+                    label_member = label_paths[image_set] + label_file_name(image_name)
+                    if label_member not in self.files:
+                        label_member = None
+                    self.images[image_set].append(ArchiveImage(image_set, image_name, file, label_member, None, info.file_size))
+
+    def index_classify(self):
+        """Buckets images stored as <image set>/<class name>/<image name> and collects the class names
+
+        Image names keep their class directory, like detect image names keep their subdirectories,
+        so they stay unique within an image set"""
+
+        class_names = set()
+        for file, info in self.files.items():
+            if file.count('/') >= 2:
+                (image_set, class1, image_name) = file.split('/', 2)
+                if image_set in self.images:
+                    class_names.add(class1)
+                    self.images[image_set].append(ArchiveImage(image_set, class1 + '/' + image_name, file, None, class1, info.file_size))
+        self.class_names = sorted(class_names)
+
+    def image_count(self):
+        """Gets the number of indexed images"""
+
+        return sum(len(self.images[image_set]) for image_set in IMAGE_SETS)
+
+    def entries(self):
+        """Gets all indexed images, image set by image set"""
+
+        for image_set in IMAGE_SETS:
+            yield from self.images[image_set]
+
+    def summary(self):
+        """Gets counts and uncompressed sizes of the indexed images and labels per image set"""
+
+        summary = {'files': len(self.files), 'bytes': sum(info.file_size for info in self.files.values())}
+        for image_set in IMAGE_SETS:
+            entries = self.images[image_set]
+            label_members = [entry.label_member for entry in entries if entry.label_member is not None]
+            summary[image_set] = {
+                'images': len(entries),
+                'labels': len(label_members),
+                'image_bytes': sum(entry.size for entry in entries),
+                'label_bytes': sum(self.files[member].file_size for member in label_members),
+            }
+        return summary
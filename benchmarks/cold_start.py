@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from run import REPO_DIR, latency, use_mongo_stand_in, write_config
+
+def child(workdir, stand_in):
+    """Imports the app in a fresh process and serves its first requests, printing the timings as JSON"""
+
+    sys.path.insert(0, workdir)
+    sys.path.insert(1, REPO_DIR)
+    if stand_in:
+        use_mongo_stand_in()
+    start = time.perf_counter()
+    import main
+    import metrics
+    import_seconds = time.perf_counter() - start
+
+    client = main.app.test_client()
+    client.get('/healthz')
+    first_response = time.time() - metrics.PROCESS_START_TIME
+    status = client.get('/readyz').status_code
+    ready = time.time() - metrics.PROCESS_START_TIME
+    print(json.dumps({'import_seconds': import_seconds, 'first_response_seconds': first_response, 'ready_seconds': ready, 'ready_status': status}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the time from process start to the first response of the app")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--mongodb-uri', default=None, help="MongoDB the readiness check pings, in-memory mongomock when omitted")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--stand-in', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child, args.stand_in)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='yolo-cold-start-')
+    write_config(workdir, args.mongodb_uri or 'mongodb://localhost:27017', {})
+    command = [sys.executable, os.path.abspath(__file__), '--child', workdir]
+    if args.mongodb_uri is None:
+        command.append('--stand-in')
+
+    runs = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        process_seconds = time.perf_counter() - start
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_seconds'] = process_seconds
+        runs.append(result)
+
+    results = {
+        'runs': args.runs,
+        'mongo': 'mongomock' if args.mongodb_uri is None else 'mongod',
+        'ready_failures': sum(1 for result in runs if result['ready_status'] != 200),
+    }
+    for name in ['import_seconds', 'first_response_seconds', 'ready_seconds', 'process_seconds']:
+        results[name.replace('_seconds', '')] = latency([result[name] for result in runs])
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
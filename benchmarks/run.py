@@ -0,0 +1,327 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from synthetic import TASKS, make_dataset
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# collections holding the documents of a dataset, removed after the benchmark
+DATASET_COLLECTIONS = ['dataset_classes', 'dataset_images', 'dataset_labels', 'dataset_class_bitmaps', 'dataset_image_ordinals', 'dataset_analytics', 'dataset_cooccurrence', 'ingest_jobs', 'uploads']
+
+# latencies below this are too noisy to compare with a baseline
+NOISE_FLOOR_MS = 1.0
+
+def percentile(samples, q):
+    """Gets the q-th percentile of samples (nearest rank)"""
+
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    rank = max(int(round(q / 100 * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+def latency(samples):
+    """Summarizes latency samples in seconds as milliseconds"""
+
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3) if samples else 0.0,
+    }
+
+def measure(function, repeat, before=None):
+    """Calls a function repeat times and gets its latency summary, before() runs untimed ahead of every call"""
+
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return latency(samples)
+
+def peak_rss_mb():
+    """Gets the peak resident set size of this process and of its finished children (thumbnail workers) in MB"""
+
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+def write_config(workdir, mongodb_uri, settings):
+    """Writes the config.py used by the app during the benchmark, with local storage under workdir"""
+
+    values = {
+        'mongodb_uri': mongodb_uri,
+        'tempdir': workdir + '/',
+        'bucket_name': 'benchmark',
+        'storage_backend': 'local',
+        'local_storage_dir': os.path.join(workdir, 'media'),
+        **settings,
+    }
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        for name, value in values.items():
+            f.write(f"{name} = {value!r}\n")
+    # spawned thumbnail workers inherit sys.path, so they import the same config
+    sys.path.insert(0, workdir)
+    sys.path.insert(1, REPO_DIR)
+
+def use_mongo_stand_in():
+    """Replaces MongoClient with mongomock's in-memory client before the app modules are imported"""
+
+    import mongomock
+    import mongomock.collection
+    import pymongo.mongo_client
+
+    # pymongo passes a sort argument to bulk updates that mongomock does not know yet
+    builder = mongomock.collection.BulkOperationBuilder
+    (add_update, add_replace) = (builder.add_update, builder.add_replace)
+    builder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+    builder.add_replace = lambda self, *args, sort=None, **kwargs: add_replace(self, *args, **kwargs)
+
+    client = mongomock.MongoClient()
+    pymongo.mongo_client.MongoClient = lambda *args, **kwargs: client
+
+def bench_ingest(helpers, workdir, task, args):
+    """Generates a dataset for a task and times its ingest"""
+
+    filename = os.path.join(workdir, f"{task}.zip")
+    start = time.perf_counter()
+    (images, labels) = make_dataset(filename, task, args.images, args.labels_per_image, args.classes, args.image_size, seed=args.seed)
+    generate_seconds = time.perf_counter() - start
+
+    datasets_table = helpers.get_db()['datasets']
+    dataset_id = str(datasets_table.insert_one({'task': task, 'name': f"benchmark {task}", 'description': "benchmark", 'upload_time': "", 'size': os.path.getsize(filename), 'yaml_extra_data': ""}).inserted_id)
+    start = time.perf_counter()
+    if not helpers.process_zip_file(filename, dataset_id, task):
+        raise RuntimeError(f"Ingest of the {task} dataset failed")
+    seconds = time.perf_counter() - start
+
+    result = {
+        'images': images,
+        'labels': labels,
+        'archive_bytes': os.path.getsize(filename),
+        'generate_seconds': round(generate_seconds, 3),
+        'seconds': round(seconds, 3),
+        'images_per_second': round(images / seconds, 1),
+        'labels_per_second': round(labels / seconds, 1),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    return dataset_id, result
+
+def bench_label_extraction(filename, task, workers_counts, shard_size=1000):
+    """Times reading and parsing every label file of a generated dataset with different numbers of label workers"""
+
+    import zipfile
+    from label_extractor import LabelExtractor
+    from synthetic import KPT_SHAPE
+
+    with zipfile.ZipFile(filename) as archive:
+        members = [name for name in archive.namelist() if name.endswith('.txt')]
+    entries = [(member.split('/')[-2], member, member) for member in members]
+    shards = [entries[i:i + shard_size] for i in range(0, len(entries), shard_size)]
+    kpt_shape = KPT_SHAPE if task == 'pose' else None
+
+    results = {}
+    for workers in workers_counts:
+        with LabelExtractor(filename, workers) as extractor:
+            start = time.perf_counter()
+            labels = sum(sum(fields['label_count'] for (image_set, image_name, fields) in shard_labels) for (shard_labels, errors, error_count, files, size, seconds) in extractor.map(iter(shards), task, kpt_shape, None))
+            seconds = time.perf_counter() - start
+        results[f"{workers}_workers"] = {'seconds': round(seconds, 3), 'labels_per_second': round(labels / seconds, 1)}
+    return results
+
+def bench_pages(app, helpers, dataset_id, repeat):
+    """Times building a page of images with labels and rendering the datasets and images views"""
+
+    def clear_caches():
+        helpers.dataset_info_cache.clear()
+        helpers.query_cache.clear()
+        helpers.page_cache.clear()
+
+    client = app.test_client()
+    image_set = 'train'
+    images = list(helpers.get_images(dataset_id, image_set, "", helpers.IMAGES_PAGE_SIZE))
+    labels = list(helpers.get_labels(dataset_id, image_set, [image['image_name'] for image in images]))
+    class_names = helpers.get_class_names(dataset_id)
+    (_, next_after) = helpers.get_images_with_labels_page(dataset_id, image_set)
+
+    def get(url):
+        def request():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {url} returned {response.status_code}")
+        return request
+
+    images_url = f"/images.html?id={dataset_id}&set={image_set}"
+    media_url = helpers.resolve_media_urls(dict(images[0]))['image_url']
+
+    def get_range(url):
+        def request():
+            response = client.get(url, headers={'Range': 'bytes=0-1023'})
+            if response.status_code != 206:
+                raise RuntimeError(f"GET {url} with Range returned {response.status_code}")
+        return request
+    results = {
+        'build_images_with_labels': measure(lambda: helpers.build_images_with_labels([dict(image) for image in images], labels, class_names), repeat),
+        'get_images_with_labels_page': measure(lambda: helpers.get_images_with_labels_page(dataset_id, image_set), repeat, clear_caches),
+        'datasets_page_cold': measure(get("/"), repeat, clear_caches),
+        'datasets_page_cached': measure(get("/"), repeat),
+        'images_page_cold': measure(get(images_url), repeat, clear_caches),
+        'images_page_cached': measure(get(images_url), repeat),
+        'images_page_next_cold': measure(get(images_url + f"&after={next_after}"), repeat, clear_caches),
+        'images_page_class_cold': measure(get(images_url + "&class=0"), repeat, clear_caches),
+        'images_page_query_cold': measure(get(images_url + "&all=0&none=1"), repeat, clear_caches),
+        'media_file': measure(get(media_url), repeat),
+        'media_range': measure(get_range(media_url), repeat),
+    }
+    for name, result in results.items():
+        result['requests_per_second'] = round(1000 / result['p50_ms'], 1) if result['p50_ms'] > 0 else 0.0
+    return results
+
+def remove_datasets(helpers, dataset_ids):
+    """Deletes the datasets created by the benchmark and the blobs no other dataset references
+
+    Blobs left behind would point at the removed temp media directory and make the next run
+    deduplicate its images against them instead of uploading them"""
+
+    from bson import ObjectId
+
+    db = helpers.get_db()
+    for dataset_id in dataset_ids:
+        for collection_name in DATASET_COLLECTIONS:
+            db[collection_name].delete_many({'dataset_id': dataset_id})
+        digests = [blob['_id'] for blob in db['blobs'].find({'datasets': dataset_id}, {'_id': 1})]
+        db['blobs'].update_many({'datasets': dataset_id}, {'$pull': {'datasets': dataset_id}})
+        db['blobs'].delete_many({'_id': {'$in': digests}, 'datasets': {'$size': 0}})
+        db['datasets'].delete_one({'_id': ObjectId(dataset_id)})
+
+def run_benchmarks(results, helpers, app, workdir, dataset_ids, args):
+    """Runs the ingest benchmark of every task, then the page benchmarks on one of the datasets"""
+
+    try:
+        for task in args.tasks:
+            print(f"Ingesting {args.images} {task} images")
+            (dataset_ids[task], results['ingest'][task]) = bench_ingest(helpers, workdir, task, args)
+            if task != 'classify':
+                print(f"Extracting {task} labels with {args.label_workers} workers")
+                results['label_extraction'][task] = bench_label_extraction(os.path.join(workdir, f"{task}.zip"), task, args.label_workers)
+        page_task = 'detect' if 'detect' in dataset_ids else args.tasks[0]
+        print(f"Rendering pages of the {page_task} dataset")
+        results['pages'] = bench_pages(app, helpers, dataset_ids[page_task], args.repeat)
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        remove_datasets(helpers, dataset_ids.values())
+
+def flatten(results, prefix=""):
+    """Flattens nested results into {'a.b.c': value}"""
+
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def find_regressions(results, baseline, tolerance):
+    """Compares results with a baseline run, throughput may not drop and latency may not grow by more than tolerance"""
+
+    (current, previous) = (flatten(results), flatten(baseline))
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not isinstance(old, (int, float)) or not isinstance(value, (int, float)) or old <= 0:
+            continue
+        if name.endswith('_per_second') and not name.endswith('requests_per_second') and value < old * (1 - tolerance):
+            regressions.append(f"{name}: {value} < {old}")
+        elif name.endswith(('p50_ms', 'p99_ms')) and max(value, old) >= NOISE_FLOOR_MS and value > old * (1 + tolerance):
+            regressions.append(f"{name}: {value} > {old}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks ingest and page rendering on synthetic YOLO datasets")
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=TASKS)
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--labels-per-image', type=int, default=5)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--image-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=50, help="requests per page measurement")
+    parser.add_argument('--label-workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}), help="label worker counts the label extraction is timed with")
+    parser.add_argument('--mongodb-uri', default=None, help="MongoDB to run against (a disposable local mongod), in-memory mongomock when omitted")
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE', help="optional config.py setting, VALUE is a Python literal")
+    parser.add_argument('--output', default=None, help="file to write the JSON results to, stdout when omitted")
+    parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    import ast
+
+    settings = {}
+    for setting in args.setting:
+        (name, value) = setting.split('=', 1)
+        settings[name] = ast.literal_eval(value)
+
+    workdir = tempfile.mkdtemp(prefix='yolo-benchmark-')
+    write_config(workdir, args.mongodb_uri or 'mongodb://localhost:27017', settings)
+    if args.mongodb_uri is None:
+        use_mongo_stand_in()
+
+    # the app logs with print, keep stdout for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        start = time.perf_counter()
+        import helpers
+        import main as app_module
+        from indexes import ensure_indexes
+        import_seconds = time.perf_counter() - start
+        ensure_indexes()
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'mongo': 'mongomock' if args.mongodb_uri is None else 'mongod',
+            'images': args.images,
+            'labels_per_image': args.labels_per_image,
+            'classes': args.classes,
+            'settings': settings,
+        },
+        'import_seconds': round(import_seconds, 3),
+        'ingest': {},
+        'label_extraction': {},
+    }
+    dataset_ids = {}
+    with contextlib.redirect_stdout(sys.stderr):
+        run_benchmarks(results, helpers, app_module.app, workdir, dataset_ids, args)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression - " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
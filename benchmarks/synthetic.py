@@ -0,0 +1,83 @@
+import argparse
+import io
+import random
+import zipfile
+
+TASKS = ['detect', 'segment', 'pose', 'classify']
+IMAGE_SETS = ['train', 'val']
+KPT_SHAPE = [17, 3]
+
+def make_image(rng, image_size):
+    """Encodes a small JPEG with random content, so images are not deduplicated"""
+
+    from PIL import Image
+
+    image = Image.new('RGB', (image_size, image_size), tuple(rng.randrange(256) for _ in range(3)))
+    pixels = image.load()
+    for _ in range(16):
+        pixels[rng.randrange(image_size), rng.randrange(image_size)] = tuple(rng.randrange(256) for _ in range(3))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+def label_row(rng, task, classes, polygon_points=8):
+    """Gets one random label line for a task"""
+
+    class_id = rng.randrange(classes)
+    (x, y) = (rng.uniform(0.2, 0.8), rng.uniform(0.2, 0.8))
+    (w, h) = (rng.uniform(0.05, 0.3), rng.uniform(0.05, 0.3))
+    values = [x, y, w, h]
+    if task == 'segment':
+        values = []
+        for _ in range(polygon_points):
+            values += [rng.uniform(x - w / 2, x + w / 2), rng.uniform(y - h / 2, y + h / 2)]
+    elif task == 'pose':
+        for _ in range(KPT_SHAPE[0]):
+            values += [rng.uniform(x - w / 2, x + w / 2), rng.uniform(y - h / 2, y + h / 2), rng.choice([0, 1, 2])]
+    return ' '.join([str(class_id)] + ['%.6f' % value if isinstance(value, float) else str(value) for value in values])
+
+def make_dataset(path, task='detect', images=1000, labels_per_image=5, classes=10, image_size=64, val_fraction=0.2, seed=0):
+    """Writes a synthetic YOLO dataset zip in the layout Ultralytics HUB expects for a task
+
+    Returns the number of images and label rows written"""
+
+    rng = random.Random(seed)
+    label_count = 0
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        if task != 'classify':
+            data_yaml = "path: .\ntrain: images/train\nval: images/val\nnames:\n"
+            data_yaml += "".join(f"  {class_id}: class{class_id}\n" for class_id in range(classes))
+            if task == 'pose':
+                data_yaml += f"kpt_shape: {KPT_SHAPE}\n"
+            archive.writestr("dataset/data.yaml", data_yaml)
+
+        for i in range(images):
+            image_set = 'val' if i < images * val_fraction else 'train'
+            image_name = f"image{i:07d}.jpg"
+            if task == 'classify':
+                archive.writestr(f"{image_set}/class{rng.randrange(classes)}/{image_name}", make_image(rng, image_size))
+                label_count += 1
+                continue
+            archive.writestr(f"dataset/images/{image_set}/{image_name}", make_image(rng, image_size))
+            rows = [label_row(rng, task, classes) for _ in range(rng.randint(max(labels_per_image // 2, 1), labels_per_image * 3 // 2 + 1))]
+            archive.writestr(f"dataset/labels/{image_set}/image{i:07d}.txt", "\n".join(rows) + "\n")
+            label_count += len(rows)
+
+    return images, label_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic YOLO dataset zip")
+    parser.add_argument('path')
+    parser.add_argument('--task', choices=TASKS, default='detect')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--labels-per-image', type=int, default=5)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--image-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    (images, labels) = make_dataset(args.path, args.task, args.images, args.labels_per_image, args.classes, args.image_size, seed=args.seed)
+    print(f"Wrote {images} images and {labels} labels to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import datetime
+
+from metrics import ingest_stage
+from pymongo import UpdateOne
+
+class BlobStore:
+    """Content-addressed image blobs shared between datasets
+
+    Every blob is recorded in the blobs collection under its SHA-256 digest, with the set of
+    datasets referencing it as reference count and flags for the stored original and variants"""
+
+    def __init__(self, db, dataset_id, batch_size=500):
+        self.collection = db['blobs']
+        self.dataset_id = dataset_id
+        self.batch_size = batch_size
+        self.stored = {'stored': [], 'thumbnail': [], 'preview': []}
+        self.seen = set()
+        self.stats = {'blobs_reused': 0, 'blobs_uploaded': 0, 'bytes_saved': 0, 'bytes_uploaded': 0}
+
+    def claim(self, blobs):
+        """Adds a reference from the dataset to (digest, size) blobs and gets the entries of those already stored"""
+
+        sizes = dict(blobs)
+        existing = {}
+        with ingest_stage('dedup') as stage:
+            for blob in self.collection.find({'_id': {'$in': list(sizes)}, 'stored': True}):
+                existing[blob['_id']] = blob
+
+            now = datetime.datetime.now(datetime.UTC)
+            requests = []
+            for digest, size in sizes.items():
+                requests.append(UpdateOne({'_id': digest}, {'$addToSet': {'datasets': self.dataset_id}, '$setOnInsert': {'size': size, 'created_time': now}}, upsert=True))
+            if requests:
+                self.collection.bulk_write(requests, ordered=False)
+            stage['items'] = len(sizes)
+
+        return existing
+
+    def count(self, size, reused):
+        """Counts an image that was either found in the store or uploaded"""
+
+        if reused:
+            self.stats['blobs_reused'] += 1
+            self.stats['bytes_saved'] += size
+        else:
+            self.stats['blobs_uploaded'] += 1
+            self.stats['bytes_uploaded'] += size
+
+    def mark_stored(self, digest, field='stored'):
+        """Records that the original (field 'stored') or a variant ('thumbnail', 'preview') of a blob has been uploaded"""
+
+        self.stored[field].append(digest)
+        if len(self.stored[field]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered stored flags"""
+
+        for field, digests in self.stored.items():
+            if digests:
+                self.collection.update_many({'_id': {'$in': digests}}, {'$set': {field: True}})
+                self.stored[field] = []
@@ -0,0 +1,81 @@
+import time
+
+from pymongo import InsertOne, ReplaceOne
+from metrics import ingest_stage
+from settings import setting
+
+DEFAULT_BATCH_SIZE = setting('insert_batch_size', 1000)
+
+class BulkWriter:
+    """Buffers writes per collection and sends them in unordered bulk_write batches
+
+    Documents are either inserted or upserted by key fields, so a batch can be written again
+    after a failure without creating duplicates"""
+
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.stats = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, collection_name, document):
+        """Queues a document insert"""
+
+        self.queue(collection_name, InsertOne(document))
+
+    def upsert(self, collection_name, document, key):
+        """Queues a document replacing the one with the same values of the key fields, inserted if there is none"""
+
+        self.queue(collection_name, ReplaceOne({field: document[field] for field in key}, document, upsert=True))
+
+    def queue(self, collection_name, operation):
+        """Queues a write operation, flushing the collection buffer once it reaches the batch size"""
+
+        buffer = self.buffers.setdefault(collection_name, [])
+        buffer.append(operation)
+        if len(buffer) >= self.batch_size:
+            self.flush_collection(collection_name)
+
+    def flush_collection(self, collection_name):
+        """Sends all buffered writes for one collection"""
+
+        buffer = self.buffers.get(collection_name)
+        if not buffer:
+            return
+        self.buffers[collection_name] = []
+
+        start = time.perf_counter()
+        with ingest_stage('write') as stage:
+            self.db[collection_name].bulk_write(buffer, ordered=False)
+            stage['items'] = len(buffer)
+        elapsed = time.perf_counter() - start
+
+        stats = self.stats.setdefault(collection_name, {'documents': 0, 'batches': 0, 'seconds': 0.0})
+        stats['documents'] += len(buffer)
+        stats['batches'] += 1
+        stats['seconds'] += elapsed
+
+    def flush(self):
+        """Sends all buffered writes for every collection"""
+
+        for collection_name in list(self.buffers):
+            self.flush_collection(collection_name)
+
+    def throughput(self):
+        """Gets per-collection write counts, batches and documents per second"""
+
+        report = {}
+        for collection_name, stats in self.stats.items():
+            report[collection_name] = dict(stats)
+            if stats['seconds'] > 0:
+                report[collection_name]['docs_per_second'] = round(stats['documents'] / stats['seconds'], 1)
+            else:
+                report[collection_name]['docs_per_second'] = 0.0
+        return report
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire a fixed number of seconds after being set"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Gets a cached value, or the default when it is missing or expired"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            (expires, value) = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches a value, evicting the least recently used entries when full"""
+
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Removes a cached value"""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        """Removes all cached values whose tuple key starts with the given tuple"""
+
+        with self.lock:
+            for key in [key for key in self.entries if key[:len(prefix)] == prefix]:
+                del self.entries[key]
+
+    def clear(self):
+        """Removes all cached values"""
+
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,39 @@
+import datetime
+
+from bson import ObjectId
+
+class IngestCheckpoint:
+    """Progress of an ingest saved on its dataset entry, so a failed ingest can be resumed from it
+
+    The checkpoint holds the current stage and how many images (in archive order) have been written
+    with their labels; it is only saved once everything before it has been flushed to MongoDB"""
+
+    def __init__(self, collection, dataset_id, images_total):
+        self.collection = collection
+        self.filter = {'_id': ObjectId(dataset_id)}
+        self.images_total = images_total
+        dataset = collection.find_one(self.filter, {'ingest_checkpoint': 1}) or {}
+        checkpoint = dataset.get('ingest_checkpoint') or {}
+        # a checkpoint taken on a different archive listing cannot be trusted
+        if checkpoint.get('images_total') != images_total:
+            checkpoint = {}
+        self.resumed = checkpoint != {}
+        self.stage = checkpoint.get('stage')
+        self.images = checkpoint.get('images', 0)
+
+    def save(self, stage, images):
+        """Records that the first images of the archive have been written"""
+
+        (self.stage, self.images) = (stage, images)
+        checkpoint = {
+            'stage': stage,
+            'images': images,
+            'images_total': self.images_total,
+            'updated_time': datetime.datetime.now(datetime.UTC),
+        }
+        self.collection.update_one(self.filter, {'$set': {'ingest_checkpoint': checkpoint}})
+
+    def clear(self):
+        """Removes the checkpoint once the ingest has finished"""
+
+        self.collection.update_one(self.filter, {'$unset': {'ingest_checkpoint': ''}})
@@ -0,0 +1,269 @@
+import datetime
+import glob
+import hashlib
+import os
+import struct
+import zipfile
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from archive_index import ArchiveIndex
+from config import *
+from db import get_db
+from settings import setting
+
+UPLOAD_CHUNK_SIZE = setting('upload_chunk_size', 8 * 1024 * 1024)
+MAX_UPLOAD_CHUNK_SIZE = setting('max_upload_chunk_size', 64 * 1024 * 1024)
+MAX_UPLOAD_SIZE = setting('max_upload_size', 20 * 1024 * 1024 * 1024)
+UPLOAD_MAX_AGE = setting('upload_max_age', 24 * 60 * 60)
+
+# the end of central directory record is 22 bytes plus a comment of up to 65535 bytes
+END_RECORD_SIZE = 22
+MAX_END_RECORD_SIZE = END_RECORD_SIZE + 65535
+ZIP64_LOCATOR_SIZE = 20
+
+class UploadError(Exception):
+    """Raised when a chunk or a manifest does not match its upload"""
+
+def create_upload(size, chunk_size=None, **fields):
+    """Records a chunked upload of a zip file of the given size and preallocates its temp file
+
+    Extra fields (dataset name, description, task) are kept until the upload is completed"""
+
+    if chunk_size is None:
+        chunk_size = UPLOAD_CHUNK_SIZE
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        raise UploadError(f"Upload size must be between 1 and {MAX_UPLOAD_SIZE} bytes")
+    if chunk_size <= 0 or chunk_size > MAX_UPLOAD_CHUNK_SIZE:
+        raise UploadError(f"Chunk size must be between 1 and {MAX_UPLOAD_CHUNK_SIZE} bytes")
+
+    upload_id = ObjectId()
+    filename = tempdir + str(upload_id) + '.zip'
+    with open(filename, 'wb') as f:
+        f.truncate(size)
+    upload = {
+        '_id': upload_id,
+        'filename': filename,
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunk_count': (size + chunk_size - 1) // chunk_size,
+        'received': [],
+        'checksums': {},
+        'status': 'receiving',
+        'fields': fields,
+        'created_time': datetime.datetime.now(datetime.UTC),
+    }
+    get_db()['uploads'].insert_one(upload)
+
+    return upload
+
+def get_upload(upload_id):
+    """Gets the entry of a chunked upload"""
+
+    try:
+        return get_db()['uploads'].find_one({'_id': ObjectId(upload_id)})
+    except InvalidId:
+        return None
+
+def chunk_range(upload, chunk):
+    """Gets the (offset, length) of a chunk in the uploaded file"""
+
+    offset = chunk * upload['chunk_size']
+    return offset, min(upload['chunk_size'], upload['size'] - offset)
+
+def missing_chunks(upload):
+    """Gets the numbers of the chunks not received yet"""
+
+    received = set(upload['received'])
+    return [chunk for chunk in range(upload['chunk_count']) if chunk not in received]
+
+def has_range(upload, start, end):
+    """Checks whether every chunk overlapping bytes start:end of the file has been received"""
+
+    received = set(upload['received'])
+    first = start // upload['chunk_size']
+    last = (end - 1) // upload['chunk_size']
+    return all(chunk in received for chunk in range(first, last + 1))
+
+def write_chunk(upload, chunk, stream, checksum, length=None):
+    """Writes a chunk read from a stream at its offset in the temp file and records it
+
+    The chunk is hashed while it is written to a side file of its own, and only copied into the
+    temp file and recorded when its SHA-256 matches the checksum; a chunk that arrived broken or
+    partially is simply sent again and never overwrites a chunk received before"""
+
+    if upload['status'] != 'receiving':
+        raise UploadError("Upload is already complete")
+    if chunk < 0 or chunk >= upload['chunk_count']:
+        raise UploadError(f"Chunk {chunk} is out of range")
+    (offset, expected) = chunk_range(upload, chunk)
+    if length is not None and length != expected:
+        raise UploadError(f"Chunk {chunk} must be {expected} bytes")
+
+    # concurrent sends of the same chunk each get their own side file
+    part_filename = upload['filename'] + '.' + str(chunk) + '.' + str(ObjectId()) + '.part'
+    try:
+        digest = hashlib.sha256()
+        read = 0
+        with open(part_filename, 'w+b') as part:
+            for piece in iter(lambda: stream.read(1024 * 1024), b''):
+                if read + len(piece) > expected:
+                    raise UploadError(f"Chunk {chunk} must be {expected} bytes")
+                digest.update(piece)
+                part.write(piece)
+                read += len(piece)
+            if read != expected:
+                raise UploadError(f"Chunk {chunk} must be {expected} bytes")
+            if digest.hexdigest() != checksum.lower():
+                raise UploadError(f"Checksum of chunk {chunk} does not match")
+
+            part.seek(0)
+            try:
+                fd = os.open(upload['filename'], os.O_WRONLY)
+            except FileNotFoundError:
+                raise UploadError("Upload has expired")
+            try:
+                written = 0
+                for piece in iter(lambda: part.read(1024 * 1024), b''):
+                    os.pwrite(fd, piece, offset + written)
+                    written += len(piece)
+            finally:
+                os.close(fd)
+    finally:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+
+    upload = get_db()['uploads'].find_one_and_update(
+        {'_id': upload['_id']},
+        {'$addToSet': {'received': chunk}, '$set': {'checksums.' + str(chunk): checksum.lower()}},
+        return_document=True,
+    )
+    if 'index' not in upload:
+        index = index_central_directory(upload)
+        if index is not None:
+            get_db()['uploads'].update_one({'_id': upload['_id']}, {'$set': {'index': index}})
+            upload['index'] = index
+
+    return upload
+
+def received_tail_start(upload):
+    """Gets the offset where the received chunks at the end of the file start"""
+
+    received = set(upload['received'])
+    chunk = upload['chunk_count']
+    while chunk > 0 and chunk - 1 in received:
+        chunk -= 1
+    return min(chunk * upload['chunk_size'], upload['size'])
+
+def central_directory_start(upload):
+    """Gets the offset of the central directory of the uploaded zip file
+
+    Returns None while the end record has not arrived and -1 when the file has no end record"""
+
+    size = upload['size']
+    tail_start = max(received_tail_start(upload), size - MAX_END_RECORD_SIZE)
+    with open(upload['filename'], 'rb') as f:
+        f.seek(tail_start)
+        tail = f.read()
+    # the end record is followed by its comment, which runs to the end of the file
+    position = tail.rfind(b'PK\x05\x06')
+    while position >= 0:
+        if len(tail) - position >= END_RECORD_SIZE:
+            comment_length = struct.unpack('<H', tail[position + 20:position + 22])[0]
+            if position + END_RECORD_SIZE + comment_length == len(tail):
+                break
+        position = tail.rfind(b'PK\x05\x06', 0, position)
+    if position < 0:
+        return -1 if tail_start == max(size - MAX_END_RECORD_SIZE, 0) else None
+
+    start = struct.unpack('<L', tail[position + 16:position + 20])[0]
+    if start != 0xFFFFFFFF:
+        return start
+    # zip64: the locator before the end record points to the zip64 end record holding the offset
+    if position < ZIP64_LOCATOR_SIZE:
+        return None if tail_start > 0 else -1
+    locator = tail[position - ZIP64_LOCATOR_SIZE:position]
+    if locator[:4] != b'PK\x06\x07':
+        return -1
+    zip64_end = struct.unpack('<Q', locator[8:16])[0]
+    if not has_range(upload, zip64_end, zip64_end + 56):
+        return None
+    with open(upload['filename'], 'rb') as f:
+        f.seek(zip64_end + 48)
+        return min(struct.unpack('<Q', f.read(8))[0], zip64_end)
+
+def index_central_directory(upload):
+    """Indexes the uploaded zip file as soon as its central directory has arrived, before the other chunks
+
+    Returns a summary of the archive (or the reason it cannot be read), None while it is incomplete"""
+
+    start = central_directory_start(upload)
+    if start is None or (start >= 0 and not has_range(upload, start, upload['size'])):
+        return None
+    if start < 0:
+        return {'error': "File is not a zip file"}
+    try:
+        with zipfile.ZipFile(upload['filename']) as archive:
+            index = ArchiveIndex(archive)
+    except zipfile.BadZipFile as error:
+        return {'error': str(error)}
+
+    summary = index.summary()
+    return {'files': summary['files'], 'bytes': summary['bytes'], 'yaml_files': index.yaml_files[:10]}
+
+def complete_upload(upload, manifest):
+    """Checks the manifest of a chunked upload against the received chunks and marks the upload complete
+
+    The manifest lists the SHA-256 of every chunk in order"""
+
+    if upload['status'] != 'receiving':
+        raise UploadError("Upload is already complete")
+    missing = missing_chunks(upload)
+    if missing:
+        raise UploadError(f"{len(missing)} chunks are missing, first missing chunk is {missing[0]}")
+    checksums = manifest.get('chunks') if isinstance(manifest, dict) else None
+    if not isinstance(checksums, list) or len(checksums) != upload['chunk_count']:
+        raise UploadError(f"Manifest must list the checksums of all {upload['chunk_count']} chunks")
+    for chunk, checksum in enumerate(checksums):
+        if str(checksum).lower() != upload['checksums'][str(chunk)]:
+            raise UploadError(f"Checksum of chunk {chunk} does not match the manifest")
+    if 'error' in upload.get('index', {}):
+        raise UploadError(upload['index']['error'])
+
+    result = get_db()['uploads'].update_one({'_id': upload['_id'], 'status': 'receiving'}, {'$set': {'status': 'complete', 'completed_time': datetime.datetime.now(datetime.UTC)}})
+    if result.modified_count == 0:
+        raise UploadError("Upload is already complete")
+
+def expire_uploads(max_age=UPLOAD_MAX_AGE):
+    """Deletes the chunked uploads still receiving chunks max_age seconds after they were started, with their temp files
+
+    Returns the number of deleted uploads"""
+
+    created_before = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=max_age)
+    count = 0
+    for upload in get_db()['uploads'].find({'status': 'receiving', 'created_time': {'$lt': created_before}}, {'filename': 1}):
+        # an upload completed meanwhile keeps its file for the ingest
+        if get_db()['uploads'].delete_one({'_id': upload['_id'], 'status': 'receiving'}).deleted_count == 0:
+            continue
+        for filename in [upload['filename']] + glob.glob(glob.escape(upload['filename']) + '.*.part'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        count += 1
+
+    return count
+
+def upload_status(upload):
+    """Gets the progress of a chunked upload as served by the API"""
+
+    return {
+        'upload_id': str(upload['_id']),
+        'status': upload['status'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'chunk_count': upload['chunk_count'],
+        'received_count': len(upload['received']),
+        'missing': missing_chunks(upload),
+        'index': upload.get('index'),
+        'dataset_id': upload.get('dataset_id'),
+        'job_id': upload.get('job_id'),
+    }
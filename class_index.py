@@ -0,0 +1,202 @@
+import array
+import bisect
+import datetime
+import numpy as np
+
+from bson import ObjectId
+from bson.binary import Binary
+from archive_index import IMAGE_SETS
+from cache import TTLCache
+from db import get_db
+from metrics import timed_query
+from settings import setting
+
+ORDINAL_CHUNK_SIZE = setting('ordinal_chunk_size', 10000)
+
+# bitmaps of one image set are loaded together, they take (images / 8) bytes per class
+bitmap_cache = TTLCache(maxsize=setting('class_index_cache_size', 64), ttl=setting('page_cache_ttl', 3600))
+
+class ClassQuery:
+    """Boolean multi-class image filter: images with all of all_of, at least one of any_of and none of none_of"""
+
+    def __init__(self, all_of=(), any_of=(), none_of=()):
+        self.all_of = sorted(set(all_of))
+        self.any_of = sorted(set(any_of))
+        self.none_of = sorted(set(none_of))
+
+    def is_empty(self):
+        return not (self.all_of or self.any_of or self.none_of)
+
+    def key(self):
+        """Gets a hashable key of the query, used in cache keys"""
+
+        return (tuple(self.all_of), tuple(self.any_of), tuple(self.none_of))
+
+def sorted_image_names(db, dataset_id, image_set):
+    """Yields the image names of an image set in name order, which gives their ordinals"""
+
+    for image in db['dataset_images'].find({'dataset_id': dataset_id, 'image_set': image_set}, {'_id': 0, 'image_name': 1}).sort('image_name', 1):
+        yield image['image_name']
+
+def build_image_set_index(db, dataset_id, image_set, chunk_size):
+    """Stores the ordinal chunks and class bitmaps of one image set, returns its number of images
+
+    Images and labels are both read in name order and merged, so only the ordinals of labelled
+    classes are held in memory while the bitmaps are built"""
+
+    labels = db['dataset_labels'].find({'dataset_id': dataset_id, 'image_set': image_set}, {'_id': 0, 'image_name': 1, 'class_ids': 1}).sort('image_name', 1)
+    label = next(labels, None)
+    (label_ordinals, label_classes) = (array.array('q'), array.array('q'))
+    (chunk, chunks) = ([], [])
+    images = 0
+    for image_name in sorted_image_names(db, dataset_id, image_set):
+        while label is not None and label['image_name'] < image_name:
+            label = next(labels, None)
+        if label is not None and label['image_name'] == image_name:
+            label_ordinals.extend([images] * len(label['class_ids']))
+            label_classes.extend(label['class_ids'])
+        chunk.append(image_name)
+        images += 1
+        if len(chunk) == chunk_size:
+            chunks.append({'dataset_id': dataset_id, 'image_set': image_set, 'start': images - len(chunk), 'first_name': chunk[0], 'image_names': chunk})
+            chunk = []
+            if len(chunks) == 10:
+                db['dataset_image_ordinals'].insert_many(chunks)
+                chunks = []
+    if chunk:
+        chunks.append({'dataset_id': dataset_id, 'image_set': image_set, 'start': images - len(chunk), 'first_name': chunk[0], 'image_names': chunk})
+    if chunks:
+        db['dataset_image_ordinals'].insert_many(chunks)
+
+    # group the ordinals by class and set them in one bitmap per class
+    ordinals = np.frombuffer(label_ordinals, dtype=np.int64)
+    classes = np.frombuffer(label_classes, dtype=np.int64)
+    order = np.argsort(classes, kind='stable')
+    (class_ids, starts) = np.unique(classes[order], return_index=True)
+    bitmaps = []
+    for class_id, class_ordinals in zip(class_ids.tolist(), np.split(ordinals[order], starts[1:])):
+        bits = np.zeros(images, dtype=bool)
+        bits[class_ordinals] = True
+        bitmaps.append({'dataset_id': dataset_id, 'image_set': image_set, 'class_id': class_id, 'images': len(class_ordinals), 'bitmap': Binary(np.packbits(bits).tobytes())})
+    if bitmaps:
+        db['dataset_class_bitmaps'].insert_many(bitmaps)
+
+    return images
+
+def build_class_index(dataset_id, db=None):
+    """Builds the inverted class index of every image set of a dataset, replacing an older one
+
+    Images get ordinals in image name order, every class gets a bitmap of the ordinals of the
+    images with a label of that class; the image counts are stored on the dataset entry. The
+    summary of an older index is removed first, so queries do not read it while it is rebuilt"""
+
+    if db is None:
+        db = get_db()
+    db['datasets'].update_one({'_id': ObjectId(dataset_id)}, {'$unset': {'class_index': 1}})
+    for collection_name in ['dataset_class_bitmaps', 'dataset_image_ordinals']:
+        db[collection_name].delete_many({'dataset_id': dataset_id})
+    class_index = {'chunk_size': ORDINAL_CHUNK_SIZE, 'image_sets': {}}
+    for image_set in IMAGE_SETS:
+        class_index['image_sets'][image_set] = build_image_set_index(db, dataset_id, image_set, ORDINAL_CHUNK_SIZE)
+    db['datasets'].update_one({'_id': ObjectId(dataset_id)}, {'$set': {'class_index': class_index}})
+    bitmap_cache.invalidate_prefix((dataset_id,))
+
+    return class_index
+
+def backfill_class_index(dataset_id, db=None):
+    """Builds the class index of a dataset ingested before the index existed
+
+    The dataset entry is claimed first, so concurrent backfills do not build it twice; returns
+    the index, or None when the dataset already has one or another process is building it"""
+
+    if db is None:
+        db = get_db()
+    claimed = db['datasets'].update_one(
+        {'_id': ObjectId(dataset_id), 'class_index': {'$exists': False}, 'class_index_building': {'$exists': False}},
+        {'$set': {'class_index_building': datetime.datetime.now(datetime.UTC)}},
+    )
+    if claimed.modified_count == 0:
+        return None
+    try:
+        return build_class_index(dataset_id, db)
+    finally:
+        db['datasets'].update_one({'_id': ObjectId(dataset_id)}, {'$unset': {'class_index_building': 1}})
+
+@timed_query
+def get_class_bitmaps(dataset_id, image_set):
+    """Gets the packed class bitmaps of an image set as {class id: uint8 array}"""
+
+    bitmaps = bitmap_cache.get((dataset_id, image_set))
+    if bitmaps is None:
+        bitmaps = {}
+        for doc in get_db()['dataset_class_bitmaps'].find({'dataset_id': dataset_id, 'image_set': image_set}, {'_id': 0, 'class_id': 1, 'bitmap': 1}):
+            bitmaps[doc['class_id']] = np.frombuffer(doc['bitmap'], dtype=np.uint8)
+        bitmap_cache.set((dataset_id, image_set), bitmaps)
+
+    return bitmaps
+
+def evaluate_query(bitmaps, images, query):
+    """Combines class bitmaps with bitwise operations, gets the packed bitmap of matching images"""
+
+    empty = np.zeros((images + 7) // 8, dtype=np.uint8)
+    result = np.packbits(np.ones(images, dtype=bool))
+    for class_id in query.all_of:
+        result &= bitmaps.get(class_id, empty)
+    if query.any_of:
+        any_bits = empty.copy()
+        for class_id in query.any_of:
+            any_bits |= bitmaps.get(class_id, empty)
+        result &= any_bits
+    for class_id in query.none_of:
+        # the padding bits of result are 0, so negating the padding does not add images
+        result &= ~bitmaps.get(class_id, empty)
+    return result
+
+def count_matches(result):
+    """Gets the number of images set in a packed bitmap"""
+
+    return int(np.bitwise_count(result).sum())
+
+@timed_query
+def first_ordinal_after(dataset_id, image_set, image_name):
+    """Gets the ordinal of the first image whose name sorts after image_name"""
+
+    if image_name == "":
+        return 0
+    chunk = get_db()['dataset_image_ordinals'].find_one({'dataset_id': dataset_id, 'image_set': image_set, 'first_name': {'$lte': image_name}}, sort=[('first_name', -1)])
+    if chunk is None:
+        return 0
+    return chunk['start'] + bisect.bisect_right(chunk['image_names'], image_name)
+
+@timed_query
+def image_names_of_ordinals(dataset_id, image_set, ordinals, chunk_size):
+    """Gets the names of images from their ordinals, reading only the chunks holding them"""
+
+    starts = sorted({ordinal // chunk_size * chunk_size for ordinal in ordinals})
+    chunks = {}
+    for chunk in get_db()['dataset_image_ordinals'].find({'dataset_id': dataset_id, 'image_set': image_set, 'start': {'$in': starts}}):
+        chunks[chunk['start']] = chunk['image_names']
+    return [chunks[ordinal // chunk_size * chunk_size][ordinal % chunk_size] for ordinal in ordinals]
+
+def query_image_names(dataset_id, image_set, class_index, query, after="", limit=50):
+    """Gets names of matching images in name order starting after the given name, and the number of matches
+
+    Returns up to limit names and the total number of images matching the query in the image set"""
+
+    images = class_index['image_sets'].get(image_set, 0)
+    chunk_size = class_index['chunk_size']
+    result = evaluate_query(get_class_bitmaps(dataset_id, image_set), images, query)
+    count = count_matches(result)
+
+    start = first_ordinal_after(dataset_id, image_set, after)
+    first_byte = start // 8
+    ordinals = []
+    # unpack the bitmap a block at a time until the page is full
+    block = max(limit * 64, 4096)
+    while len(ordinals) < limit and first_byte < len(result):
+        bits = np.unpackbits(result[first_byte:first_byte + block])
+        found = np.flatnonzero(bits) + first_byte * 8
+        ordinals.extend(found[(found >= start) & (found < images)][:limit - len(ordinals)].tolist())
+        first_byte += block
+
+    return image_names_of_ordinals(dataset_id, image_set, ordinals, chunk_size), count
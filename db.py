@@ -0,0 +1,51 @@
+import certifi
+import threading
+
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+from config import *
+from settings import setting
+
+DATABASE_NAME = 'yolo_datasets'
+
+MAX_POOL_SIZE = setting('mongo_max_pool_size', 20)
+MIN_POOL_SIZE = setting('mongo_min_pool_size', 0)
+MAX_IDLE_TIME_MS = setting('mongo_max_idle_time_ms', 300000)
+CONNECT_TIMEOUT_MS = setting('mongo_connect_timeout_ms', 5000)
+SERVER_SELECTION_TIMEOUT_MS = setting('mongo_server_selection_timeout_ms', 5000)
+
+_client = None
+_lock = threading.Lock()
+
+def get_client():
+    """Gets the MongoDB client shared by the whole process, creating it on first use
+
+    The client connects lazily on its first operation, so importing the app does no network round
+    trip, and it is created after gunicorn forks its workers"""
+
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = MongoClient(
+                    mongodb_uri,
+                    server_api=ServerApi('1'),
+                    tlsCAFile=certifi.where(),
+                    connect=False,
+                    maxPoolSize=MAX_POOL_SIZE,
+                    minPoolSize=MIN_POOL_SIZE,
+                    maxIdleTimeMS=MAX_IDLE_TIME_MS,
+                    connectTimeoutMS=CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS,
+                )
+    return _client
+
+def get_db():
+    """Gets the yolo_datasets database of the shared client"""
+
+    return get_client()[DATABASE_NAME]
+
+def ping():
+    """Checks that MongoDB answers, raising the connection error when it does not"""
+
+    get_client().admin.command('ping')
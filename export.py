@@ -0,0 +1,173 @@
+import io
+import json
+import zipfile
+import yaml
+
+from archive_index import IMAGE_SETS, label_file_name
+from helpers import get_class_names, get_dataset_info, get_images, get_labels, resolve_media_urls
+from labels import decode_labels, label_lines
+from settings import setting
+from storage_backends import get_storage_backend
+from thumbnails import image_key
+
+EXPORT_BATCH_SIZE = setting('export_batch_size', 500)
+EXPORT_CHUNK_SIZE = setting('export_chunk_size', 1024 * 1024)
+EXPORT_COMPRESSION_LEVEL = setting('export_compression_level', 6)
+
+# data.yaml fields kept from the uploaded archive, image set paths are rewritten for the export layout
+YAML_EXTRA_FIELDS = ['kpt_shape', 'flip_idx', 'download']
+
+class ZipStream(io.RawIOBase):
+    """Write-only, unseekable file that collects what zipfile writes so it can be sent as it is produced"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Gets and forgets everything written since the last call"""
+
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def dataset_batches(dataset_id, image_set, batch_size=EXPORT_BATCH_SIZE):
+    """Yields the images of an image set batch by batch with their label documents, sorted by image name
+
+    Each batch is one keyset page of get_images(), so no cursor is held open while the export is sent"""
+
+    after = ""
+    while True:
+        images = list(get_images(dataset_id, image_set, after, batch_size))
+        if not images:
+            return
+        label_docs = {label['image_name']: label for label in get_labels(dataset_id, image_set, [image['image_name'] for image in images])}
+        yield [(image, label_docs.get(image['image_name'])) for image in images]
+        if len(images) < batch_size:
+            return
+        after = images[-1]['image_name']
+
+def stored_image_key(backend, image):
+    """Gets the storage key of the original of an image document"""
+
+    if 'image_key' in image:
+        return image['image_key']
+    if 'sha256' in image:
+        return image_key(image['sha256'], image['image_name'])
+    key = backend.key(image['image_url'])
+    if key is None:
+        raise ValueError(f"Image {image['image_name']} is not stored in the configured storage backend")
+    return key
+
+def export_image_sets(dataset):
+    """Gets the image sets of a dataset that have images"""
+
+    image_sets = dataset.get('stats', {}).get('image_sets', {})
+    return [image_set for image_set in IMAGE_SETS if image_sets.get(image_set, {}).get('images', 0) > 0]
+
+def build_data_yaml(dataset, class_names):
+    """Builds the data.yaml of an exported dataset from its class names and the extra data of the uploaded YAML file"""
+
+    yaml_extra_data = json.loads(dataset.get('yaml_extra_data') or '{}')
+    data = {'path': '.'}
+    for image_set in export_image_sets(dataset):
+        data[image_set] = 'images/' + image_set
+    data['names'] = {int(class_id): class_name for class_id, class_name in sorted(class_names.items())}
+    for field in YAML_EXTRA_FIELDS:
+        if field in yaml_extra_data:
+            data[field] = yaml_extra_data[field]
+    return yaml.safe_dump(data, sort_keys=False, allow_unicode=True)
+
+def image_member(task, image, label_doc, class_names):
+    """Gets the path of an image in the exported archive"""
+
+    if task != 'classify':
+        return 'images/' + image['image_set'] + '/' + image['image_name']
+    if '/' in image['image_name']: # classify image names keep their class directory
+        return image['image_set'] + '/' + image['image_name']
+    class_id = label_doc['class_ids'][0] if label_doc is not None and label_doc['class_ids'] else None
+    return image['image_set'] + '/' + class_names.get(class_id, 'unlabelled') + '/' + image['image_name']
+
+def write_member(archive, stream, member, source, compress_type):
+    """Copies a file object into the archive, yielding the compressed output as it is produced"""
+
+    info = zipfile.ZipInfo(member, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = compress_type
+    info.external_attr = 0o644 << 16
+    with archive.open(info, 'w') as dest:
+        while True:
+            data = source.read(EXPORT_CHUNK_SIZE)
+            if not data:
+                break
+            dest.write(data)
+            output = stream.drain()
+            if output:
+                yield output
+    # the local file header, or the data descriptor after the data, is written on close
+    yield stream.drain()
+
+def export_zip(dataset_id):
+    """Yields a YOLO layout zip archive of an ingested dataset in chunks, built while it is sent
+
+    Labels and data.yaml are deflated, images are stored as they are since they are compressed
+    already; images are streamed from the storage backend and documents are read in keyset pages,
+    so only one batch of documents and one chunk of an image are held in memory"""
+
+    dataset = get_dataset_info(dataset_id)
+    task = dataset.get('task', 'detect')
+    class_names = get_class_names(dataset_id)
+    backend = get_storage_backend()
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compresslevel=EXPORT_COMPRESSION_LEVEL) as archive:
+        if task != 'classify':
+            yield from write_member(archive, stream, 'data.yaml', io.BytesIO(build_data_yaml(dataset, class_names).encode()), zipfile.ZIP_DEFLATED)
+        for image_set in export_image_sets(dataset):
+            for batch in dataset_batches(dataset_id, image_set):
+                for image, label_doc in batch:
+                    with backend.open(stored_image_key(backend, image)) as source:
+                        yield from write_member(archive, stream, image_member(task, image, label_doc, class_names), source, zipfile.ZIP_STORED)
+                    if task != 'classify' and label_doc is not None:
+                        text = ''.join(line + '\n' for (class_id, line) in label_lines(label_doc))
+                        label_member = 'labels/' + image_set + '/' + label_file_name(image['image_name'])
+                        yield from write_member(archive, stream, label_member, io.BytesIO(text.encode()), zipfile.ZIP_DEFLATED)
+    # closing the archive writes its central directory
+    yield stream.drain()
+
+def export_ndjson(dataset_id):
+    """Yields the labels of an ingested dataset as newline-delimited JSON, one line per image
+
+    Coordinates are rounded to the precision of the label text, images are not read"""
+
+    dataset = get_dataset_info(dataset_id)
+    class_names = get_class_names(dataset_id)
+    for image_set in export_image_sets(dataset):
+        for batch in dataset_batches(dataset_id, image_set):
+            lines = []
+            for image, label_doc in batch:
+                labels = []
+                if label_doc is not None:
+                    decoded = decode_labels(label_doc)
+                    for row, class_id in enumerate(decoded.class_ids.tolist()):
+                        values = decoded.values[decoded.offsets[row]:decoded.offsets[row + 1]].tolist()
+                        labels.append({'class_id': class_id, 'class_name': class_names.get(class_id, str(class_id)), 'coordinates': [float('%.6g' % value) for value in values]})
+                record = {
+                    'image_set': image_set,
+                    'image_name': image['image_name'],
+                    'image_url': resolve_media_urls(image)['image_url'],
+                    'sha256': image.get('sha256'),
+                    'labels': labels,
+                }
+                lines.append(json.dumps(record) + '\n')
+            yield ''.join(lines)
+
+def export_filename(dataset, extension):
+    """Gets the download file name of an exported dataset"""
+
+    name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in dataset.get('name') or 'dataset')
+    return name + extension
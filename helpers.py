@@ -1,47 +1,111 @@
 import math
-import requests
-import certifi
 import zipfile
 import yaml
 import json
+import itertools
 
 from flask import redirect, render_template, request
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
 from config import *
-from google.cloud import storage
-
-client = MongoClient(mongodb_uri, server_api=ServerApi('1'), tlsCAFile=certifi.where())
-
-def get_datasets():
-    """Gets summary entries for uploaded datasets"""
-
-    datasets = client['yolo_datasets']['datasets'].aggregate([
+from bson import ObjectId
+from bson.errors import InvalidId
+from collections import deque
+from archive_index import ArchiveIndex, IMAGE_SETS
+from blob_store import BlobStore
+from bulk_writer import BulkWriter
+from cache import TTLCache
+from checkpoint import IngestCheckpoint
+from class_index import ClassQuery, bitmap_cache, build_class_index, query_image_names
+from db import get_db
+from labels import MAX_REPORTED_LABEL_ERRORS, encode_labels, label_lines, parse_label_file
+from label_extractor import LabelExtractor
+from metrics import ingest_stage, record_stage, timed_query
+from pipeline import threaded
+from progress import NullProgress
+from settings import setting
+from storage_backends import get_storage_backend
+from thumbnails import ThumbnailGenerator, image_key, preview_key, thumbnail_key
+from uploader import ImageUploader
+
+IMAGES_PAGE_SIZE = setting('images_page_size', 50)
+LABEL_BATCH_SIZE = setting('label_batch_size', 1000)
+DEDUP_BATCH_SIZE = setting('dedup_batch_size', 500)
+CHECKPOINT_INTERVAL = setting('checkpoint_interval', 1000)
+
+# fields identifying a document written during ingest, writes are upserts on them
+CLASS_KEY = ['dataset_id', 'class_id']
+IMAGE_KEY = ['dataset_id', 'image_set', 'image_name']
+
+# blobs flag, storage key and URL fields of the original, thumbnail and preview of an image
+MEDIA_FIELDS = [('stored', 'image_key'), ('thumbnail', 'thumbnail_key'), ('preview', 'preview_key')]
+MEDIA_URL_FIELDS = {'image_key': 'image_url', 'thumbnail_key': 'thumbnail_url', 'preview_key': 'preview_url'}
+
+# dataset summaries only change when an ingest finishes, which invalidates them
+dataset_info_cache = TTLCache(maxsize=setting('dataset_cache_size', 256), ttl=setting('dataset_cache_ttl', 300))
+
+# query results and rendered pages of ingested datasets, keyed by (dataset id, ...) tuples
+query_cache = TTLCache(maxsize=setting('query_cache_size', 1024), ttl=setting('page_cache_ttl', 3600))
+page_cache = TTLCache(maxsize=setting('page_cache_size', 512), ttl=setting('page_cache_ttl', 3600))
+
+def datasets_pipeline():
+    """Builds the aggregation pipeline of get_datasets()"""
+
+    return [
         {
             '$sort': {
                 'upload_time': -1
             }
         },
-    ])
+    ]
+
+@timed_query
+def get_datasets():
+    """Gets summary entries for uploaded datasets"""
+
+    datasets = get_db()['datasets'].aggregate(datasets_pipeline())
 
     return datasets
 
+@timed_query
 def get_dataset_info(dataset_id):
     """Gets summary entry for a dataset"""
 
-    datasets = client['yolo_datasets']['datasets'].aggregate([
-        {
-            '$sort': {
-                'upload_time': -1
-            }
-        },
-    ])
+    dataset = dataset_info_cache.get(dataset_id)
+    if dataset is None:
+        try:
+            dataset = get_db()['datasets'].find_one({'_id': ObjectId(dataset_id)})
+        except InvalidId:
+            return {}
+        if dataset is None:
+            return {}
+        if 'ingested' not in dataset:
+            dataset = backfill_ingested(dataset)
+        dataset_info_cache.set(dataset_id, dataset)
 
-    for dataset in datasets:
-        if str(dataset['_id']) == dataset_id:
-            return dataset
+    return dict(dataset)
 
-    return {}
+def backfill_ingested(dataset):
+    """Sets the ingested flag, and the stats when missing, on a dataset entry from before the flag existed
+
+    Datasets uploaded before ingest jobs were ingested during the upload request and have no job,
+    the others are ingested once their last job is done; entries still being ingested are left as
+    they are and get the flag when their ingest finishes"""
+
+    dataset_id = str(dataset['_id'])
+    db = get_db()
+    last_job = db['ingest_jobs'].find_one({'dataset_id': dataset_id}, sort=[('created_time', -1)])
+    if last_job is not None and last_job['status'] != 'done':
+        return dict(dataset, ingested=False)
+
+    fields = {'ingested': True}
+    if 'stats' not in dataset:
+        fields['stats'] = compute_dataset_stats(dataset_id)
+    db['datasets'].update_one({'_id': dataset['_id'], 'ingested': {'$exists': False}}, {'$set': fields})
+    return dict(dataset, **fields)
+
+def is_ingested(dataset_id):
+    """Checks whether the ingest of a dataset has finished, after which its data no longer changes"""
+
+    return get_dataset_info(dataset_id).get('ingested', False)
 
 def convert_size(size_bytes):
     """https://stackoverflow.com/questions/5194057/better-way-to-convert-file-sizes-in-python"""
@@ -53,39 +117,89 @@ def convert_size(size_bytes):
     s = round(size_bytes / p, 2)
     return "%s %s" % (s, size_name[i])
 
-def build_datasets_info(datasets, classes, images):
-    """Combines counts of classes and images to datasets info"""
+def build_datasets_info(datasets):
+    """Adds counts of classes and images stored on the dataset entries to datasets info"""
 
     datasets_info = []
 
-    class_data = {}
-    for class1 in classes:
-        class_data[class1['_id']] = class1['count']
-
-    image_data = {}
-    for image1 in images:
-        image_data[image1['_id']] = image1['count']
-
     for dataset in datasets:
-        dataset1 = dataset
+        dataset1 = dataset if 'ingested' in dataset else backfill_ingested(dataset)
         dataset1['id'] = str(dataset['_id'])
-        if dataset1['id'] in class_data:
-            dataset1['classes_count'] = class_data[dataset1['id']]
-        else:    
-            dataset1['classes_count'] = 0
-        if dataset1['id'] in image_data:
-            dataset1['images_count'] = image_data[dataset1['id']]
-        else:    
-            dataset1['images_count'] = 0
+        stats = dataset1.get('stats', {})
+        dataset1['classes_count'] = stats.get('classes', 0)
+        dataset1['images_count'] = stats.get('images', 0)
+        dataset1['labels_count'] = stats.get('labels', 0)
         dataset1['dataset_size'] = convert_size(dataset1['size'])
         datasets_info.append(dataset1)
 
     return datasets_info
 
-def get_classes(dataset_id):
-    """Gets list of classes for a dataset"""
+def new_dataset_stats():
+    """Creates empty class, image and label counts for a dataset"""
+
+    stats = {'classes': 0, 'images': 0, 'labels': 0, 'image_sets': {}}
+    for image_set in IMAGE_SETS:
+        stats['image_sets'][image_set] = {'images': 0, 'labels': 0}
+    return stats
+
+def add_dataset_stats(stats, image_set, counter, n=1):
+    """Adds to the image or label count of a dataset and of one of its image sets"""
+
+    stats[counter] += n
+    stats['image_sets'][image_set][counter] += n
 
-    classes = client['yolo_datasets']['dataset_classes'].aggregate([
+@timed_query
+def compute_dataset_stats(dataset_id):
+    """Counts classes, images and labels of a dataset from its collections"""
+
+    db = get_db()
+    stats = new_dataset_stats()
+    stats['classes'] = db['dataset_classes'].count_documents({'dataset_id': dataset_id})
+    for image_set in IMAGE_SETS:
+        add_dataset_stats(stats, image_set, 'images', db['dataset_images'].count_documents({'dataset_id': dataset_id, 'image_set': image_set}))
+    label_counts = db['dataset_labels'].aggregate([
+        {
+            '$match': {
+                'dataset_id': dataset_id
+            }
+        }, {
+            '$group': {
+                '_id': '$image_set',
+                'count': {'$sum': '$label_count'}
+            }
+        },
+    ])
+    for label_count in label_counts:
+        if label_count['_id'] in stats['image_sets']:
+            add_dataset_stats(stats, label_count['_id'], 'labels', label_count['count'])
+    return stats
+
+@timed_query
+def save_dataset_stats(dataset_id, stats, **fields):
+    """Stores class, image and label counts (and other fields) on the dataset entry"""
+
+    get_db()['datasets'].update_one({'_id': ObjectId(dataset_id)}, {'$set': {'stats': stats, **fields}})
+    invalidate_dataset_caches(dataset_id)
+
+def recompute_dataset_stats(dataset_id=None):
+    """Recounts and stores the stats of one dataset, or of all datasets when no id is given"""
+
+    if dataset_id is None:
+        dataset_ids = [str(dataset['_id']) for dataset in get_db()['datasets'].find({}, {'_id': 1})]
+    else:
+        dataset_ids = [dataset_id]
+
+    for dataset_id in dataset_ids:
+        stats = compute_dataset_stats(dataset_id)
+        save_dataset_stats(dataset_id, stats)
+        print(dataset_id, stats)
+
+    return len(dataset_ids)
+
+def classes_pipeline(dataset_id):
+    """Builds the aggregation pipeline of get_classes()"""
+
+    return [
         {
             '$match': {
                 'dataset_id': dataset_id
@@ -95,41 +209,63 @@ def get_classes(dataset_id):
                 'class_id': 1
             }
         },
-    ])
+    ]
+
+@timed_query
+def get_classes(dataset_id):
+    """Gets list of classes for a dataset"""
+
+    classes = get_db()['dataset_classes'].aggregate(classes_pipeline(dataset_id))
 
     return classes
 
 def get_class_names(dataset_id):
     """Gets list of classes for a dataset"""
 
-    classes = get_classes(dataset_id)
+    class_names = query_cache.get((dataset_id, 'class_names'))
+    if class_names is None:
+        classes = get_classes(dataset_id)
 
-    class_names = {}
-    for class1 in classes:
-        class_names[class1['class_id']] = class1['class_name']
+        class_names = {}
+        for class1 in classes:
+            class_names[class1['class_id']] = class1['class_name']
+        if is_ingested(dataset_id):
+            query_cache.set((dataset_id, 'class_names'), class_names)
 
     return class_names
 
-def get_label_counts(dataset_id, image_set):
-    """Gets counts of labels for a dataset"""
+def label_counts_pipeline(dataset_id, image_set):
+    """Builds the aggregation pipeline of get_label_counts()"""
 
-    labels = client['yolo_datasets']['dataset_labels'].aggregate([
+    # class_counts[i] is the number of labels of class class_ids[i] in an image
+    return [
         {
             '$match': {
                 'dataset_id': dataset_id,
                 'image_set': image_set
             }
+        }, {
+            '$unwind': {
+                'path': '$class_ids',
+                'includeArrayIndex': 'class_index'
+            }
         }, {
             '$group': {
-                "_id": "$class_id",
-                "count": {'$sum': 1}
+                "_id": "$class_ids",
+                "count": {'$sum': {'$arrayElemAt': ['$class_counts', '$class_index']}}
             }
         }, {
             '$sort': {
-                'class_id': 1
+                '_id': 1
             }
         },
-    ])
+    ]
+
+@timed_query
+def get_label_counts(dataset_id, image_set):
+    """Gets counts of labels for a dataset"""
+
+    labels = get_db()['dataset_labels'].aggregate(label_counts_pipeline(dataset_id, image_set))
 
     return labels
 
@@ -152,100 +288,288 @@ def build_classes_counts(classes, labels):
 
     return classes_counts
 
-def get_class_counts():
-    """Gets counts of classes for all datasets"""
+def get_classes_counts(dataset_id, image_set):
+    """Gets list of classes with counts of labels for a specific dataset and image set"""
 
-    class_counts = client['yolo_datasets']['dataset_classes'].aggregate([
+    classes_counts = query_cache.get((dataset_id, 'classes_counts', image_set))
+    if classes_counts is None:
+        classes = get_classes(dataset_id)
+        labels = get_label_counts(dataset_id, image_set)
+        classes_counts = build_classes_counts(classes, labels)
+        if is_ingested(dataset_id):
+            query_cache.set((dataset_id, 'classes_counts', image_set), classes_counts)
+
+    return classes_counts
+
+def invalidate_dataset_caches(dataset_id):
+    """Drops the cached summary, query results and pages of a dataset and the cached datasets list"""
+
+    dataset_info_cache.invalidate(dataset_id)
+    query_cache.invalidate_prefix((dataset_id,))
+    bitmap_cache.invalidate_prefix((dataset_id,))
+    page_cache.invalidate_prefix((dataset_id,))
+    page_cache.invalidate_prefix(('datasets',))
+
+def images_pipeline(dataset_id, image_set, after="", limit=IMAGES_PAGE_SIZE):
+    """Builds the aggregation pipeline of get_images()"""
+
+    match = {
+        'dataset_id': dataset_id,
+        'image_set': image_set
+    }
+    if after != "":
+        match['image_name'] = {'$gt': after}
+
+    return [
         {
-            '$group': {
-                "_id": "$dataset_id",
-                "count": {'$sum': 1}
+            '$match': match
+        }, {
+            '$sort': {
+                'image_name': 1
             }
-        }
-    ])
+        }, {
+            '$limit': limit
+        },
+    ]
+
+@timed_query
+def get_images(dataset_id, image_set, after="", limit=IMAGES_PAGE_SIZE):
+    """Gets one page of images for a dataset, sorted by image name and starting after the given image name"""
+
+    images = get_db()['dataset_images'].aggregate(images_pipeline(dataset_id, image_set, after, limit))
+
+    return images
 
-    return class_counts
+def class_image_names_pipeline(dataset_id, image_set, class_id, after="", limit=IMAGES_PAGE_SIZE):
+    """Builds the aggregation pipeline of get_class_image_names(), class_id is a class id or a condition on class_ids"""
 
-def get_image_counts():
-    """Gets counts of images for all datasets"""
+    match = {
+        'dataset_id': dataset_id,
+        'image_set': image_set,
+        'class_ids': class_id
+    }
+    if after != "":
+        match['image_name'] = {'$gt': after}
 
-    image_counts = client['yolo_datasets']['dataset_images'].aggregate([
+    return [
         {
-            '$group': {
-                "_id": "$dataset_id",
-                "count": {'$sum': 1}
+            '$match': match
+        }, {
+            '$sort': {
+                'image_name': 1
             }
-        }
-    ])
+        }, {
+            '$limit': limit
+        }, {
+            '$project': {
+                '_id': 0,
+                'image_name': 1
+            }
+        },
+    ]
+
+@timed_query
+def get_class_image_names(dataset_id, image_set, class_id, after="", limit=IMAGES_PAGE_SIZE):
+    """Gets one page of names of images that have a label of the given class (or whose classes match a condition)"""
+
+    image_names = get_db()['dataset_labels'].aggregate(class_image_names_pipeline(dataset_id, image_set, class_id, after, limit))
 
-    return image_counts
+    return [image_name['image_name'] for image_name in image_names]
 
-def get_images(dataset_id, image_set):
-    """Gets list of images for a dataset"""
+def images_by_name_pipeline(dataset_id, image_set, image_names):
+    """Builds the aggregation pipeline of get_images_by_name()"""
 
-    images = client['yolo_datasets']['dataset_images'].aggregate([
+    return [
         {
             '$match': {
                 'dataset_id': dataset_id,
-                'image_set': image_set
+                'image_set': image_set,
+                'image_name': {'$in': image_names}
             }
         }, {
             '$sort': {
                 'image_name': 1
             }
         },
-    ])
+    ]
+
+@timed_query
+def get_images_by_name(dataset_id, image_set, image_names):
+    """Gets the images of a dataset with the given names"""
+
+    images = get_db()['dataset_images'].aggregate(images_by_name_pipeline(dataset_id, image_set, image_names))
 
     return images
 
-def get_labels(dataset_id, image_set):
-    """Gets list of image labels for a dataset"""
+def labels_pipeline(dataset_id, image_set, image_names):
+    """Builds the aggregation pipeline of get_labels()"""
 
-    image_labels = client['yolo_datasets']['dataset_labels'].aggregate([
+    return [
         {
             '$match': {
                 'dataset_id': dataset_id,
-                'image_set': image_set
+                'image_set': image_set,
+                'image_name': {'$in': image_names}
             }
         }, {
             '$sort': {
-                'image_name': 1,
-                'class_id': 1
+                'image_name': 1
             }
         },
-    ])
+    ]
+
+@timed_query
+def get_labels(dataset_id, image_set, image_names):
+    """Gets list of labels for the given images of a dataset"""
+
+    image_labels = get_db()['dataset_labels'].aggregate(labels_pipeline(dataset_id, image_set, image_names))
 
     return image_labels
 
-def build_images_with_labels(images, image_labels, class_id, class_names):
-    """Build list of images with labels for a dataset"""
+def resolve_media_urls(image):
+    """Sets the URLs of an image document from its storage keys, images ingested before keys were stored keep their URLs"""
 
-    images_with_labels = []
+    backend = get_storage_backend()
+    for key_field, url_field in MEDIA_URL_FIELDS.items():
+        if key_field in image:
+            image[url_field] = backend.url(image[key_field])
+    return image
+
+def build_images_with_labels(images, image_labels, class_names):
+    """Build list of images with labels for a dataset"""
 
     image_data = {}
     for image1 in images:
-        image_data[image1['image_name']] = image1
+        image_data[image1['image_name']] = resolve_media_urls(image1)
         image_data[image1['image_name']]['labels'] = set()
         image_data[image1['image_name']]['label_names'] = ""
-        image_data[image1['image_name']]['label_data'] = []
+        image_data[image1['image_name']]['label_doc'] = None
 
+    # packed label arrays are only decoded when label_data() is called for an image
     for label in image_labels:
-        image_name = label['image_name']
-        if label['class_id'] not in image_data[image_name]['labels']:
-            if image_data[label['image_name']]['label_names'] != "":
-                image_data[label['image_name']]['label_names'] += ", "
-            image_data[label['image_name']]['label_names'] += class_names[label['class_id']]
-            image_data[image_name]['labels'].add(label['class_id'])
-        image_data[label['image_name']]['label_data'].append((label['class_id'], label['label_data']))
-    print(image_data)
-
-    for image in image_data:
-        print(class_id)
-        print(image_data[image]['labels'])
-        if class_id == "" or int(class_id) in image_data[image]['labels']:
-            images_with_labels.append(image_data[image])
-    
-    return images_with_labels
+        image = image_data[label['image_name']]
+        image['labels'].update(label['class_ids'])
+        image['label_names'] = ", ".join(class_names.get(class_id, str(class_id)) for class_id in label['class_ids'])
+        image['label_doc'] = label
+
+    return list(image_data.values())
+
+def label_data(image):
+    """Gets the label lines of an image built by build_images_with_labels as (class id, line) tuples"""
+
+    if image['label_doc'] is None:
+        return []
+    return label_lines(image['label_doc'])
+
+def get_images_with_labels_page(dataset_id, image_set, class_id="", after="", limit=IMAGES_PAGE_SIZE):
+    """Gets one page of images with labels, filtered by class in MongoDB
+
+    Returns the images and the image name the next page starts after ("" on the last page)"""
+
+    # fetch one extra image to find out whether there is a next page
+    if class_id == "":
+        images = list(get_images(dataset_id, image_set, after, limit + 1))
+    else:
+        image_names = get_class_image_names(dataset_id, image_set, int(class_id), after, limit + 1)
+        images = list(get_images_by_name(dataset_id, image_set, image_names))
+
+    next_after = ""
+    if len(images) > limit:
+        images = images[:limit]
+        next_after = images[-1]['image_name']
+
+    image_labels = get_labels(dataset_id, image_set, [image['image_name'] for image in images])
+    class_names = get_class_names(dataset_id)
+    images_with_labels = build_images_with_labels(images, image_labels, class_names)
+
+    return images_with_labels, next_after
+
+def parse_class_query(dataset_id, all_of="", any_of="", none_of=""):
+    """Builds a class query from comma separated class ids or names, raises ValueError for unknown classes"""
+
+    if not (all_of or any_of or none_of):
+        return ClassQuery()
+    class_ids = {class_name: class_id for class_id, class_name in get_class_names(dataset_id).items()}
+
+    def parse(value):
+        parsed = []
+        for token in value.split(','):
+            token = token.strip()
+            if token == "":
+                continue
+            if token in class_ids:
+                parsed.append(class_ids[token])
+            elif token.isdigit():
+                parsed.append(int(token))
+            else:
+                raise ValueError("Unknown class " + token)
+        return parsed
+
+    return ClassQuery(parse(all_of), parse(any_of), parse(none_of))
+
+def class_query_condition(query):
+    """Gets the class_ids condition of dataset_labels documents matching a class query"""
+
+    condition = {}
+    if query.all_of:
+        condition['$all'] = query.all_of
+    if query.any_of:
+        condition['$in'] = query.any_of
+    if query.none_of:
+        condition['$nin'] = query.none_of
+    return condition
+
+@timed_query
+def count_class_images(dataset_id, image_set, condition):
+    """Counts the labelled images of an image set whose classes match a class_ids condition"""
+
+    return get_db()['dataset_labels'].count_documents({'dataset_id': dataset_id, 'image_set': image_set, 'class_ids': condition})
+
+def filter_image_names(dataset_id, image_set, query, after="", limit=IMAGES_PAGE_SIZE):
+    """Gets names of images matching a class query with MongoDB filters, and the number of matches
+
+    Used for datasets without a class index; a query with only none_of classes also matches the
+    images without labels, so it walks the images and leaves out those having one of the classes"""
+
+    if query.all_of or query.any_of:
+        condition = class_query_condition(query)
+        return get_class_image_names(dataset_id, image_set, condition, after, limit), count_class_images(dataset_id, image_set, condition)
+
+    excluded_condition = {'$in': query.none_of}
+    image_names = []
+    while len(image_names) < limit:
+        page = [image['image_name'] for image in get_images(dataset_id, image_set, after, limit)]
+        if not page:
+            break
+        excluded = {label['image_name'] for label in get_labels(dataset_id, image_set, page) if set(label['class_ids']) & set(query.none_of)}
+        image_names.extend(image_name for image_name in page if image_name not in excluded)
+        after = page[-1]
+    images = get_dataset_info(dataset_id).get('stats', {}).get('image_sets', {}).get(image_set, {}).get('images', 0)
+    return image_names[:limit], images - count_class_images(dataset_id, image_set, excluded_condition)
+
+def get_images_with_labels_query_page(dataset_id, image_set, query, after="", limit=IMAGES_PAGE_SIZE):
+    """Gets one page of images with labels matching a boolean class query, answered from the class bitmaps
+
+    Returns the images, the image name the next page starts after ("" on the last page) and the number of matching images"""
+
+    class_index = get_dataset_info(dataset_id).get('class_index')
+    if class_index is None:
+        # datasets ingested before the index existed get it from `flask --app main build-class-index`
+        (image_names, count) = filter_image_names(dataset_id, image_set, query, after, limit + 1)
+    else:
+        (image_names, count) = query_image_names(dataset_id, image_set, class_index, query, after, limit + 1)
+
+    next_after = ""
+    if len(image_names) > limit:
+        image_names = image_names[:limit]
+        next_after = image_names[-1]
+
+    images = list(get_images_by_name(dataset_id, image_set, image_names))
+    image_labels = get_labels(dataset_id, image_set, image_names)
+    class_names = get_class_names(dataset_id)
+    images_with_labels = build_images_with_labels(images, image_labels, class_names)
+
+    return images_with_labels, next_after, count
 
 def parse_yaml_file(yaml_filename):
     try:
@@ -261,232 +585,266 @@ def parse_yaml_file(yaml_filename):
     
     return data
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name, zip_file_name):
-    """Uploads a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+def image_upload_jobs(pairs, blob_store, pending, batch_size=DEDUP_BATCH_SIZE):
+    """Yields the upload job of every (entry, processed image) pair, leaving out blobs that are already stored
+
+    Jobs hold the original under its content-addressed key, then its thumbnail and preview if
+    made; (entry, processed image, blobs) tuples are appended to pending in the same order"""
+
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            return
+        existing = blob_store.claim([(processed['sha256'], processed['size']) for (image, processed) in batch])
+        for entry, processed in batch:
+            image = entry[0]
+            digest = processed['sha256']
+            stored = existing.get(digest, {})
+            # images repeated within this ingest are only uploaded once
+            repeated = digest in blob_store.seen
+            blob_store.seen.add(digest)
+            reused = repeated or stored.get('stored', False)
+            key = image_key(digest, image.image_name)
+            blobs = [(None if reused else image.member, key)]
+            if 'thumbnail' in processed:
+                thumbnail_stored = repeated or stored.get('thumbnail', False)
+                blobs.append((None if thumbnail_stored else processed['thumbnail'], thumbnail_key(key)))
+                if 'preview' in processed:
+                    preview_stored = repeated or stored.get('preview', False)
+                    blobs.append((None if preview_stored else processed['preview'], preview_key(key)))
+            blob_store.count(processed['size'], reused)
+            pending.append((entry, processed, blobs))
+            yield blobs
+
+def compact_dataset_labels(dataset_id):
+    """Converts the labels of a dataset stored as one document per label line to one packed document per image"""
+
+    db = get_db()
+    dataset = get_dataset_info(dataset_id)
+    old_labels = db['dataset_labels'].aggregate([
+        {
+            '$match': {
+                'dataset_id': dataset_id,
+                'label_data': {'$exists': True}
+            }
+        }, {
+            '$group': {
+                '_id': {'image_set': '$image_set', 'image_name': '$image_name'},
+                'class_ids': {'$push': '$class_id'},
+                'lines': {'$push': '$label_data'}
+            }
+        },
+    ], allowDiskUse=True)
 
-    #blob.upload_from_filename(source_file_name)
-    archive = zipfile.ZipFile(zip_file_name)
-    f = archive.open(source_file_name, 'r')
-    blob.upload_from_file(f)
-    f.close()
+    count = 0
+    with BulkWriter(db) as writer:
+        for old_label in old_labels:
+            if all(line == '' for line in old_label['lines']): # classify labels have no coordinates
+                fields = encode_labels(old_label['class_ids'], [], [0] * (len(old_label['class_ids']) + 1))
+            else:
+                parsed = parse_label_file('\n'.join(old_label['lines']).encode(), dataset.get('task', 'detect'))
+                fields = encode_labels(parsed.class_ids, parsed.values, parsed.offsets)
+            writer.add('dataset_labels', {'dataset_id': dataset_id, **old_label['_id'], **fields})
+            count += 1
+    db['dataset_labels'].delete_many({'dataset_id': dataset_id, 'label_data': {'$exists': True}})
+    invalidate_dataset_caches(dataset_id)
 
-    print(
-        f"File {source_file_name} uploaded to {destination_blob_name} in bucket {bucket_name}."
-    )
+    return count
 
-def upload_image(dataset_id, image_name, image_url, zip_file_name):
-    bucket_file_name = str(dataset_id) + "_" + image_name
-    upload_blob(bucket_name, image_url, bucket_file_name, zip_file_name)
-    return "http://storage.googleapis.com/" + str(bucket_name) + "/" + bucket_file_name
+def classify_entries(images, class_ids):
+    """Yields (image, packed label fields) for indexed classify images, labelled by their class directory"""
 
-def process_zip_file(filename, dataset_id, task = "detect"):
+    for image in images:
+        yield image, encode_labels([class_ids[image.class_name]], [], [0, 0])
+
+def label_shards(images, batches):
+    """Splits indexed images into shards of LABEL_BATCH_SIZE consecutive images, appending every shard to batches"""
+
+    while True:
+        batch = list(itertools.islice(images, LABEL_BATCH_SIZE))
+        if not batch:
+            return
+        batches.append(batch)
+        yield [(image.image_set, image.image_name, image.label_member) for image in batch]
+
+def labelled_entries(extractor, images, task, kpt_shape, class_ids, progress):
+    """Reads the label files of indexed images shard by shard in the extractor's process pool
+
+    Yields (image, packed label fields or None) in index order"""
+
+    label_errors = 0
+    batches = deque()
+    for (batch_labels, errors, error_count, files, size, seconds) in extractor.map(label_shards(images, batches), task, kpt_shape, class_ids):
+        batch = batches.popleft()
+        record_stage('labels', seconds, files, size)
+        # invalid label lines are skipped, the first few are reported on the job
+        for error in errors[:max(MAX_REPORTED_LABEL_ERRORS - label_errors, 0)]:
+            print("Error - Invalid label " + error)
+            progress.error("Invalid label " + error)
+        label_errors += error_count
+        progress.set('invalid_labels', label_errors)
+        fields = {(image_set, image_name): label_fields for (image_set, image_name, label_fields) in batch_labels}
+        for image in batch:
+            yield image, fields.get((image.image_set, image.image_name))
+        progress.add('images_scanned', len(batch))
+
+def process_zip_file(filename, dataset_id, task = "detect", progress = None):
+    if progress is None:
+        progress = NullProgress()
     try:
+        progress.phase('scanning')
         with zipfile.ZipFile(filename) as archive:
+            with ingest_stage('scan') as stage:
+                index = ArchiveIndex(archive)
+                stage['items'] = len(index.files)
             if task == "classify": # classify zip = no YAML file, sort images into classes based on directory structure
                 yaml_data = {}
-                class_names = []
-                (train_images, val_images, test_images) = ({}, {}, {})
-                for file in archive.namelist():
-                    if file[-1] != '/' and file.count('/') >= 2:
-                        (image_set, class1, image_name) = file.split('/', 2)
-                        if image_set in ['train', 'val', 'test']:
-                            if class1 not in class_names:
-                                class_names.append(class1)
-                            if image_set == 'train':
-                                if class1 not in train_images:
-                                    train_images[class1] = []
-                                train_images[class1].append(image_name) 
-                            if image_set == 'val':
-                                if class1 not in val_images:
-                                    val_images[class1] = []
-                                val_images[class1].append(image_name)
-                            if image_set == 'test':
-                                if class1 not in test_images:
-                                    test_images[class1] = []
-                                test_images[class1].append(image_name)
-                class_names.sort()
+                index.index_classify()
                 classes = {}
-                for i in range(0, len(class_names)):
-                    classes[i] = class_names[i]
+                for i in range(0, len(index.class_names)):
+                    classes[i] = index.class_names[i]
                 class_ids = {}
                 for i in classes:
                     class_ids[classes[i]] = i
-                images = []
-                labels = []
-                for class1 in train_images:
-                    for image in train_images[class1]:
-                        images.append(('train', image, 'train' + '/' + class1 + '/' + image))
-                        class_id = class_ids[class1]
-                        labels.append(('train', image, class_id, ''))
-                for class1 in val_images:
-                    for image in val_images[class1]:
-                        images.append(('val', image, 'val' + '/' + class1 + '/' + image))
-                        class_id = class_ids[class1]
-                        labels.append(('val', image, class_id, ''))
-                for class1 in test_images:
-                    for image in test_images[class1]:
-                        images.append(('test', image, 'test' + '/' + class1 + '/' + image))
-                        class_id = class_ids[class1]
-                        labels.append(('test', image, class_id, ''))
-                #print(classes)
-                #print(images)
-                #print(labels)
             else:
-                # list all files
-                #archive.printdir()
                 # try to find YAML file and main path
-                yaml_file = ""
-                for file in archive.namelist():
-                    #print(file)
-                    if file[-5:] == ".yaml":
-                        file_info = archive.getinfo(file)
-                        if file_info.is_dir() is False:
-                            if yaml_file != "":
-                                print("Error - Multiple YAML files detected")
-                                return False
-                            yaml_file = file
-                if yaml_file == "":
+                if len(index.yaml_files) > 1:
+                    print("Error - Multiple YAML files detected")
+                    progress.error("Multiple YAML files detected")
+                    return False
+                if len(index.yaml_files) == 0:
                     print("Error - No YAML file detected")
+                    progress.error("No YAML file detected")
                     return False
+                yaml_file = index.yaml_files[0]
                 print(yaml_file)
                 yaml_path = '/'.join(yaml_file.split('/')[:-1])
                 if yaml_path != "":
                     yaml_path += "/"
                 print(yaml_path)
                 # read YAML file to extract paths and class names
-                yaml_data = {}
                 try:
-                    f = archive.open(yaml_file, 'r')
-                    data = yaml.load(f, Loader=yaml.SafeLoader)
+                    with ingest_stage('yaml') as stage:
+                        f = archive.open(yaml_file, 'r')
+                        data = yaml.load(f, Loader=yaml.SafeLoader)
+                        f.close()
+                        stage['items'] = 1
+                        stage['bytes'] = archive.getinfo(yaml_file).file_size
                     print(data)
-                    f.close()
+                    yaml_data = data
                 except FileNotFoundError:
                     print("Error - YAML file cannot be found")
+                    progress.error("YAML file cannot be found")
                     return False
                 except yaml.scanner.ScannerError:
                     print("Error - Invalid YAML file format")
+                    progress.error("Invalid YAML file format")
                     return False
-                # get images and labels
-                (train_images, val_images, test_images) = ([], [], [])
-                (train_labels, val_labels, test_labels) = ({}, {}, {})
                 for key in data:
                     print(key, data[key])
-                (train_path, val_path, test_path) = (None, None, None)
-                if 'train' in data and data['train'] != None:
-                    train_path = yaml_path + data['train'] + '/'
-                if 'val' in data and data['val'] != None:
-                    val_path = yaml_path + data['val'] + '/'
-                if 'test' in data and data['test'] != None:
-                    test_path = yaml_path + data['test'] + '/'
-                for file in archive.namelist():
-                    if train_path != None and file.startswith(train_path) and file != train_path:
-                        file_info = archive.getinfo(file)
-                        if file_info.is_dir() is False:
-                            train_images.append(file[len(train_path):])
-                    if val_path != None and file.startswith(val_path) and file != val_path:
-                        file_info = archive.getinfo(file)
-                        if file_info.is_dir() is False:
-                            val_images.append(file[len(val_path):])
-                    if test_path != None and file.startswith(test_path) and file != test_path:
-                        file_info = archive.getinfo(file)
-                        if file_info.is_dir() is False:
-                            test_images.append(file[len(test_path):])
+                # get images and labels
+                (image_paths, label_paths) = ({}, {})
+                for image_set in IMAGE_SETS:
+                    if image_set in data and data[image_set] != None:
+                        image_paths[image_set] = yaml_path + data[image_set] + '/'
+                        label_paths[image_set] = yaml_path + data[image_set].replace('images/', 'labels/') + '/'
+                index.index_detect(image_paths, label_paths)
                 classes = {}
                 if 'names' in data and data['names'] != None:
                     classes = data['names']
-                images = []
-                labels = []
-                (train_label_path, val_label_path, test_label_path) = ('', '', '')
-                if 'train' in data and data['train'] != None:
-                    train_label_path = yaml_path + data['train'].replace('images/', 'labels/') + '/'
-                if 'val' in data and data['val'] != None:
-                    val_label_path = yaml_path + data['val'].replace('images/', 'labels/') + '/'
-                if 'test' in data and data['test'] != None:
-                    test_label_path = yaml_path + data['test'].replace('images/', 'labels/') + '/'
-                for image in train_images:
-                    images.append(('train', image, train_path + image))
-                    label_filename = '.'.join(image.split('.')[:-1]) + '.txt'
-                    if label_filename == '.txt':
-                        label_filename = image + '.txt'
-                    label_file = train_label_path + label_filename
-                    if label_file in archive.namelist():
-                        f = archive.open(label_file, 'r')
-                        label_data = f.read()
-                        f.close()
-
-                        label_lines = label_data.decode().split('\n')
-                        for label_line in label_lines:
-                            line = label_line.strip()
-                            if line != '':
-                                class_id = line.split(' ')[0]
-                                if class_id.isnumeric():
-                                    class_id = int(class_id)
-                                labels.append(('train', image, class_id, line))
-                for image in val_images:
-                    images.append(('val', image, val_path + image))
-                    label_filename = '.'.join(image.split('.')[:-1]) + '.txt'
-                    if label_filename == '.txt':
-                        label_filename = image + '.txt'
-                    label_file = val_label_path + label_filename
-                    if label_file in archive.namelist():
-                        f = archive.open(label_file, 'r')
-                        label_data = f.read()
-                        f.close()
-                        label_lines = label_data.decode().split('\n')
-                        for label_line in label_lines:
-                            line = label_line.strip()
-                            if line != '':
-                                class_id = line.split(' ')[0]
-                                if class_id.isnumeric():
-                                    class_id = int(class_id)
-                                labels.append(('val', image, class_id, line))
-                for image in test_images:
-                    images.append(('test', image, test_path + image))
-                    label_filename = '.'.join(image.split('.')[:-1]) + '.txt'
-                    if label_filename == '.txt':
-                        label_filename = image + '.txt'
-                    label_file = test_label_path + label_filename
-                    if label_file in archive.namelist():
-                        f = archive.open(label_file, 'r')
-                        label_data = f.read()
-                        f.close()
-                        label_lines = label_data.decode().split('\n')
-                        for label_line in label_lines:
-                            line = label_line.strip()
-                            if line != '':
-                                class_id = line.split(' ')[0]
-                                if class_id.isnumeric():
-                                    class_id = int(class_id)
-                                labels.append(('test', image, class_id, line))
-                #print(classes)
-                #print(images)
-                #print(labels)
+                    if isinstance(classes, list):
+                        classes = dict(enumerate(classes))
+            print(index.summary())
+            progress.set('classes_total', len(classes))
+            progress.set('images_total', index.image_count())
+
+            # write YAML extra data into MongoDB
+            yaml_extra_data = {}
+            for field in ['train', 'val', 'test', 'kpt_shape', 'flip_idx', 'download']:
+                if field in yaml_data:
+                    yaml_extra_data[field] = yaml_data[field]
+            filter_yaml = {'_id': ObjectId(dataset_id)}
+            yaml_value = { "$set": {'yaml_extra_data': json.JSONEncoder().encode(yaml_extra_data)} }
+            get_db()['datasets'].update_one(filter_yaml, yaml_value)
+
+            # images stream through the pipeline: labels are parsed in a background thread, images are
+            # hashed (and thumbnailed) in worker processes, new blobs are uploaded by a thread pool and
+            # documents are written in batches; every stage holds a bounded number of images
+            checkpoint = IngestCheckpoint(get_db()['datasets'], dataset_id, index.image_count())
+            if checkpoint.resumed:
+                print(f"Resuming ingest of {dataset_id} after {checkpoint.images} images")
+                progress.set('images_resumed', checkpoint.images)
+            images = itertools.islice(index.entries(), checkpoint.images, None)
+            with LabelExtractor(filename) as extractor:
+                if task == "classify":
+                    entries = classify_entries(images, class_ids)
+                else:
+                    entries = labelled_entries(extractor, images, task, yaml_data.get('kpt_shape'), set(classes) if classes else None, progress)
+                entries = threaded(entries, name='labels')
+                ingest_entries(filename, dataset_id, classes, entries, checkpoint, progress)
     except zipfile.BadZipFile as error:
         print(error)
+        progress.error(str(error))
         return False
-    
-    # write YAML extra data into MongoDB
-    yaml_extra_data = {}
-    for field in ['train', 'val', 'test', 'kpt_shape', 'flip_idx', 'download']:
-        if field in yaml_data:
-            yaml_extra_data[field] = yaml_data[field]
-    filter_yaml = {'_id': dataset_id}
-    yaml_value = { "$set": {'yaml_extra_data': json.JSONEncoder().encode(yaml_extra_data)} }
-    client['yolo_datasets']['datasets'].update_one(filter_yaml, yaml_value)
-
-    # write classes, images, labels data into MongoDB
-    for class1 in classes:
-        class_data = {'dataset_id': dataset_id, 'class_id': int(class1), 'class_name': classes[class1]}
-        client['yolo_datasets']['dataset_classes'].insert_one(class_data)
-    for image in images:
-        uploaded_image_url = upload_image(dataset_id, image[1], image[2], filename)
-        image_data = {'dataset_id': dataset_id, 'image_set': image[0], 'image_name': image[1], 'image_url': uploaded_image_url} # image_url = image[2] for mock
-        client['yolo_datasets']['dataset_images'].insert_one(image_data)
-    for label in labels:
-        label_data = {'dataset_id': dataset_id, 'image_set': label[0], 'image_name': label[1], 'class_id': label[2], 'label_data': label[3]}
-        client['yolo_datasets']['dataset_labels'].insert_one(label_data)
+    progress.phase('done')
 
     return True
+
+def ingest_entries(filename, dataset_id, classes, entries, checkpoint, progress):
+    """Uploads the images of a stream of (image, packed label fields) entries and writes their documents
+
+    Writes are upserts keyed on the image and a checkpoint is saved every CHECKPOINT_INTERVAL images,
+    so the entries after the last checkpoint can be ingested again after a failure"""
+
+    stats = new_dataset_stats()
+    stats['classes'] = len(classes)
+    blob_store = BlobStore(get_db(), dataset_id)
+    with BulkWriter(get_db()) as writer, ImageUploader(get_storage_backend(), filename) as uploader, ThumbnailGenerator(filename) as thumbnailer:
+        for class1 in classes:
+            class_data = {'dataset_id': dataset_id, 'class_id': int(class1), 'class_name': classes[class1]}
+            writer.upsert('dataset_classes', class_data, CLASS_KEY)
+        progress.phase('ingesting')
+        # the thumbnailer yields in member order, so entries are matched back to its results in order
+        hashing = deque()
+        def members():
+            for entry in entries:
+                hashing.append(entry)
+                yield entry[0].member
+        pairs = ((hashing.popleft(), processed) for processed in thumbnailer.map(members()))
+        pending = deque()
+        images_done = checkpoint.images
+        # uploads finish in image order, the keys of every image are taken from pending
+        for _ in uploader.map(image_upload_jobs(pairs, blob_store, pending)):
+            ((image, label_fields), processed, blobs) = pending.popleft()
+            image_data = {'dataset_id': dataset_id, 'image_set': image.image_set, 'image_name': image.image_name, 'sha256': processed['sha256']}
+            # storage keys are stored instead of URLs, which are built from them when a page is rendered
+            for (source, key), (field, key_field) in zip(blobs, MEDIA_FIELDS):
+                if source is not None:
+                    blob_store.mark_stored(processed['sha256'], field)
+                image_data[key_field] = key
+            writer.upsert('dataset_images', image_data, IMAGE_KEY)
+            add_dataset_stats(stats, image.image_set, 'images')
+            progress.add('images', 1)
+            if label_fields is not None:
+                label_doc = {'dataset_id': dataset_id, 'image_set': image.image_set, 'image_name': image.image_name, **label_fields}
+                writer.upsert('dataset_labels', label_doc, IMAGE_KEY)
+                add_dataset_stats(stats, image.image_set, 'labels', label_fields['label_count'])
+                progress.add('labels', label_fields['label_count'])
+            images_done += 1
+            if images_done % CHECKPOINT_INTERVAL == 0:
+                writer.flush()
+                blob_store.flush()
+                checkpoint.save('ingesting', images_done)
+        blob_store.flush()
+        progress.set('images_deduplicated', blob_store.stats['blobs_reused'])
+        progress.set('bytes_saved', blob_store.stats['bytes_saved'])
+    print(writer.throughput())
+    print(uploader.throughput())
+    print(blob_store.stats)
+    if checkpoint.resumed:
+        # part of the dataset was written by the failed run, count it from the collections
+        stats = compute_dataset_stats(dataset_id)
+    progress.phase('indexing')
+    build_class_index(dataset_id)
+    save_dataset_stats(dataset_id, stats, ingested=True)
+    checkpoint.clear()
@@ -0,0 +1,153 @@
+import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from db import get_db
+from helpers import *
+
+# compound indexes serving the $match/$sort prefix of every query helper in helpers.py
+INDEXES = {
+    'datasets': [
+        IndexModel([('upload_time', DESCENDING)], name='upload_time'),
+    ],
+    'ingest_jobs': [
+        IndexModel([('dataset_id', ASCENDING), ('created_time', DESCENDING)], name='dataset_created_time'),
+    ],
+    'uploads': [
+        IndexModel([('status', ASCENDING), ('created_time', ASCENDING)], name='status_created_time'),
+    ],
+    'dataset_classes': [
+        IndexModel([('dataset_id', ASCENDING), ('class_id', ASCENDING)], name='dataset_class'),
+    ],
+    'dataset_images': [
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('image_name', ASCENDING)], name='dataset_set_image'),
+    ],
+    'dataset_labels': [
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('image_name', ASCENDING)], name='dataset_set_image'),
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('class_ids', ASCENDING), ('image_name', ASCENDING)], name='dataset_set_classes_image'),
+    ],
+    'dataset_analytics': [
+        IndexModel([('dataset_id', ASCENDING)], name='dataset'),
+    ],
+    'dataset_cooccurrence': [
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('start', ASCENDING)], name='dataset_set_start'),
+    ],
+    'dataset_class_bitmaps': [
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('class_id', ASCENDING)], name='dataset_set_class'),
+    ],
+    'dataset_image_ordinals': [
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('start', ASCENDING)], name='dataset_set_start'),
+        IndexModel([('dataset_id', ASCENDING), ('image_set', ASCENDING), ('first_name', ASCENDING)], name='dataset_set_first_name'),
+    ],
+}
+
+# stages that mean a query is not served by an index
+BAD_PLAN_STAGES = {'COLLSCAN', 'SORT'}
+
+def ensure_indexes(db=None):
+    """Creates the declared indexes, existing indexes with the same keys are left as they are"""
+
+    if db is None:
+        db = get_db()
+
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        created[collection_name] = db[collection_name].create_indexes(indexes)
+
+    return created
+
+def query_checks(dataset_id, image_set):
+    """Gets (query name, collection, query) for every query helper, built with sample arguments
+
+    The query is an aggregate pipeline, or a dict with the filter and sort of a find"""
+
+    return [
+        ('get_datasets', 'datasets', datasets_pipeline()),
+        ('get_classes', 'dataset_classes', classes_pipeline(dataset_id)),
+        ('get_label_counts', 'dataset_labels', label_counts_pipeline(dataset_id, image_set)),
+        ('get_images', 'dataset_images', images_pipeline(dataset_id, image_set)),
+        ('get_images (next page)', 'dataset_images', images_pipeline(dataset_id, image_set, 'a')),
+        ('get_class_image_names', 'dataset_labels', class_image_names_pipeline(dataset_id, image_set, 0, 'a')),
+        ('get_class_image_names (class query)', 'dataset_labels', class_image_names_pipeline(dataset_id, image_set, {'$all': [0, 1], '$nin': [2]}, 'a')),
+        ('get_images_by_name', 'dataset_images', images_by_name_pipeline(dataset_id, image_set, ['a', 'b'])),
+        ('get_labels', 'dataset_labels', labels_pipeline(dataset_id, image_set, ['a', 'b'])),
+        ('count_class_images', 'dataset_labels', {'filter': {'dataset_id': dataset_id, 'image_set': image_set, 'class_ids': {'$all': [0, 1], '$nin': [2]}}}),
+        ('label_batches', 'dataset_labels', {'filter': {'dataset_id': dataset_id, 'image_set': image_set}}),
+        ('get_analytics', 'dataset_analytics', {'filter': {'dataset_id': dataset_id}}),
+        ('get_cooccurrence', 'dataset_cooccurrence', {'filter': {'dataset_id': dataset_id, 'image_set': image_set}, 'sort': {'start': 1}}),
+        ('get_class_bitmaps', 'dataset_class_bitmaps', {'filter': {'dataset_id': dataset_id, 'image_set': image_set}}),
+        ('first_ordinal_after', 'dataset_image_ordinals', {'filter': {'dataset_id': dataset_id, 'image_set': image_set, 'first_name': {'$lte': 'a'}}, 'sort': {'first_name': -1}}),
+        ('image_names_of_ordinals', 'dataset_image_ordinals', {'filter': {'dataset_id': dataset_id, 'image_set': image_set, 'start': {'$in': [0, 10000]}}}),
+        ('backfill_ingested, resume_ingest_job', 'ingest_jobs', {'filter': {'dataset_id': dataset_id}, 'sort': {'created_time': -1}}),
+        ('expire_uploads', 'uploads', {'filter': {'status': 'receiving', 'created_time': {'$lt': datetime.datetime.now(datetime.UTC)}}}),
+    ]
+
+def explain_command(collection_name, query):
+    """Gets the command explaining a query of query_checks(), only the index served part of a pipeline"""
+
+    if isinstance(query, dict):
+        return {'find': collection_name, **query}
+    return {'aggregate': collection_name, 'pipeline': index_served_prefix(query), 'cursor': {}}
+
+def index_served_prefix(pipeline):
+    """Gets the stages of a pipeline before its first $group, the part that can be served by an index"""
+
+    prefix = []
+    for stage in pipeline:
+        if '$group' in stage:
+            break
+        prefix.append(stage)
+    return prefix
+
+def plan_stages(plan):
+    """Gets the stage names of a winning query plan, skipping rejected plans"""
+
+    stages = []
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'rejectedPlans':
+                continue
+            if key == 'stage':
+                stages.append(value)
+            else:
+                stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+def winning_plans(explain):
+    """Gets the winning plans from the output of an aggregate or find explain"""
+
+    plans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                plans.append(value)
+            else:
+                plans.extend(winning_plans(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            plans.extend(winning_plans(value))
+    return plans
+
+def check_query_plans(db=None, dataset_id=None, image_set='train'):
+    """Explains every query helper and returns the queries whose plan uses a COLLSCAN or an in-memory SORT"""
+
+    if db is None:
+        db = get_db()
+    if dataset_id is None:
+        dataset = db['datasets'].find_one({}, {'_id': 1})
+        dataset_id = str(dataset['_id']) if dataset is not None else 'explain'
+
+    failures = []
+    for name, collection_name, query in query_checks(dataset_id, image_set):
+        explain = db.command('explain', explain_command(collection_name, query), verbosity='queryPlanner')
+        stages = []
+        for plan in winning_plans(explain):
+            stages.extend(plan_stages(plan))
+        bad_stages = sorted(BAD_PLAN_STAGES.intersection(stages))
+        print(name, collection_name, ' > '.join(stages), 'FAIL' if bad_stages else 'OK')
+        if bad_stages:
+            failures.append((name, bad_stages))
+
+    return failures
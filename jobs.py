@@ -0,0 +1,112 @@
+import datetime
+import os
+import traceback
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from concurrent.futures import ThreadPoolExecutor
+from db import get_db
+from analytics import compute_analytics
+from helpers import process_zip_file
+from progress import JobProgress
+from settings import setting
+
+INGEST_WORKERS = setting('ingest_workers', 2)
+
+_executor = None
+
+def get_executor():
+    """Gets the ingest worker pool, creating it on first use"""
+
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+    return _executor
+
+def create_ingest_job(filename, dataset_id, task, resumed_from=None):
+    """Records a queued ingest job for an uploaded zip file"""
+
+    job = {
+        'dataset_id': dataset_id,
+        'filename': filename,
+        'task': task,
+        'status': 'queued',
+        'phase': None,
+        'counts': {},
+        'throughput': {},
+        'errors': [],
+        'created_time': datetime.datetime.now(datetime.UTC),
+    }
+    if resumed_from is not None:
+        job['resumed_from'] = resumed_from
+    return get_db()['ingest_jobs'].insert_one(job).inserted_id
+
+def submit_ingest_job(filename, dataset_id, task):
+    """Records an ingest job for an uploaded zip file and queues it on the worker pool"""
+
+    job_id = create_ingest_job(filename, dataset_id, task)
+    get_executor().submit(run_ingest_job, job_id, filename, dataset_id, task)
+
+    return str(job_id)
+
+def run_ingest_job(job_id, filename, dataset_id, task):
+    """Runs process_zip_file for a job and records its final status
+
+    The archive is deleted once the ingest is done and kept after a failure, so it can be resumed"""
+
+    get_db()['ingest_jobs'].update_one({'_id': job_id}, {'$set': {'status': 'running', 'started_time': datetime.datetime.now(datetime.UTC)}})
+    progress = JobProgress(get_db()['ingest_jobs'], job_id)
+    try:
+        status = 'done' if process_zip_file(filename, dataset_id, task, progress) else 'failed'
+    except Exception as error:
+        traceback.print_exc()
+        progress.error(repr(error))
+        status = 'failed'
+    if status == 'done':
+        # analytics can be computed again with recompute-analytics, so a failure here does not fail the ingest
+        progress.phase('analytics')
+        try:
+            compute_analytics(dataset_id)
+        except Exception as error:
+            traceback.print_exc()
+            progress.error("Analytics failed: " + repr(error))
+        progress.phase('done')
+    progress.flush()
+    get_db()['ingest_jobs'].update_one({'_id': job_id}, {'$set': {'status': status, 'finished_time': datetime.datetime.now(datetime.UTC)}})
+    if status == 'done' and os.path.exists(filename):
+        os.remove(filename)
+
+    return status
+
+def resume_ingest_job(dataset_id, force=False):
+    """Records a job continuing the last failed ingest of a dataset from its checkpoint
+
+    A queued or running job is only resumed with force, for jobs left behind by a crashed process;
+    a job still running would otherwise ingest the same archive concurrently and delete it when done.
+    Returns the new job id, filename and task, or None when there is nothing to resume"""
+
+    last_job = get_db()['ingest_jobs'].find_one({'dataset_id': dataset_id}, sort=[('created_time', -1)])
+    if last_job is None or last_job['status'] == 'done':
+        return None
+    if last_job['status'] != 'failed' and not force:
+        print(f"Error - Last ingest job of dataset {dataset_id} is {last_job['status']}, use force if its process is gone")
+        return None
+    if not os.path.exists(last_job['filename']):
+        print(f"Error - Archive {last_job['filename']} of dataset {dataset_id} no longer exists")
+        return None
+    job_id = create_ingest_job(last_job['filename'], dataset_id, last_job['task'], resumed_from=last_job['_id'])
+
+    return job_id, last_job['filename'], last_job['task']
+
+def get_job(job_id):
+    """Gets the status entry of an ingest job"""
+
+    try:
+        job = get_db()['ingest_jobs'].find_one({'_id': ObjectId(job_id)})
+    except InvalidId:
+        return None
+    if job is not None:
+        job['_id'] = str(job['_id'])
+        if 'resumed_from' in job:
+            job['resumed_from'] = str(job['resumed_from'])
+    return job
@@ -0,0 +1,68 @@
+import os
+import time
+
+from functools import partial
+from labels import encode_labels, parse_label_files
+from pipeline import ordered_map, process_pool, worker_archive
+from settings import setting
+
+LABEL_WORKERS = setting('label_workers', os.cpu_count() or 1)
+
+def extract_labels(zip_file_name, shard, task, kpt_shape, class_ids):
+    """Reads and parses the label files of a shard of images in one vectorized pass, run in a worker process
+
+    shard is a list of (image set, image name, label member) tuples. Returns (image set, image name,
+    packed label fields) tuples of the labelled images, the first validation errors and the number
+    of invalid rows, the number of label files and bytes read and the seconds spent"""
+
+    start = time.perf_counter()
+    archive = worker_archive(zip_file_name)
+
+    labelled = [(image_set, image_name, label_member) for (image_set, image_name, label_member) in shard if label_member is not None]
+    label_datas = [archive.read(label_member) for (image_set, image_name, label_member) in labelled]
+    parsed = parse_label_files(label_datas, task, kpt_shape, class_ids, [label_member for (image_set, image_name, label_member) in labelled])
+
+    labels = []
+    for i, (image_set, image_name, label_member) in enumerate(labelled):
+        (first_row, end_row) = (parsed.file_rows[i], parsed.file_rows[i + 1])
+        if first_row == end_row:
+            continue
+        offsets = parsed.offsets[first_row:end_row + 1]
+        values = parsed.values[offsets[0]:offsets[-1]]
+        labels.append((image_set, image_name, encode_labels(parsed.class_ids[first_row:end_row], values, offsets - offsets[0])))
+
+    return labels, parsed.errors, parsed.error_count, len(labelled), sum(len(label_data) for label_data in label_datas), time.perf_counter() - start
+
+class LabelExtractor:
+    """Reads and parses the label files of a zip archive shard by shard in a process pool
+
+    Every worker opens its own handle on the archive; results are returned in shard order, so the
+    output does not depend on the number of workers or on which shard finishes first"""
+
+    def __init__(self, zip_file_name, workers=LABEL_WORKERS):
+        self.zip_file_name = zip_file_name
+        self.workers = workers
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def map(self, shards, task, kpt_shape, class_ids, max_in_flight=None):
+        """Extracts the labels of shards keeping up to max_in_flight running, yields their results in shard order"""
+
+        if self.executor is None:
+            self.executor = process_pool(self.workers)
+        if max_in_flight is None:
+            max_in_flight = self.workers * 2
+        extract = partial(extract_labels, self.zip_file_name, task=task, kpt_shape=kpt_shape, class_ids=class_ids)
+        return ordered_map(self.executor, extract, shards, max_in_flight)
+
+    def close(self):
+        """Stops the worker processes"""
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,210 @@
+import numpy as np
+
+from bson.binary import Binary
+from collections import namedtuple
+
+# parsed label rows of one or more label files:
+# class_ids[i] is the class of row i, its coordinates are values[offsets[i]:offsets[i + 1]],
+# the rows of file j are file_rows[j]:file_rows[j + 1], error_count is the number of rows that
+# failed validation (they are left out of the other fields) and errors describes the first
+# max_errors of them
+ParsedLabels = namedtuple('ParsedLabels', ['class_ids', 'values', 'offsets', 'file_rows', 'errors', 'error_count'])
+
+# invalid label rows described in the errors of a parse, the others are only counted
+MAX_REPORTED_LABEL_ERRORS = 20
+
+# class ids are stored as uint16
+MAX_CLASS_ID = np.iinfo(np.uint16).max
+
+WHITESPACE = np.array([ord(c) for c in ' \t\r\n\v\f'], dtype=np.uint8)
+
+def coordinate_count(task, kpt_shape=None):
+    """Gets the number of coordinates of a label row for a task, None when it varies (segment polygons)"""
+
+    if task == 'segment':
+        return None
+    if task == 'obb':
+        return 8
+    if task == 'pose' and kpt_shape:
+        return 4 + kpt_shape[0] * kpt_shape[1]
+    return 4
+
+def coordinate_mask(task, kpt_shape=None):
+    """Gets which columns of a fixed width label row are x/y coordinates (pose keypoint visibility is not)"""
+
+    count = coordinate_count(task, kpt_shape)
+    mask = np.ones(count, dtype=bool)
+    if task == 'pose' and kpt_shape and kpt_shape[1] == 3:
+        mask[4 + 2::3] = False
+    return mask
+
+def split_rows(data):
+    """Splits label text into tokens and gets the number of tokens of every non-empty line"""
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if len(buffer) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    is_space = np.isin(buffer, WHITESPACE)
+    # a token starts at a non-space byte that follows a space byte (or the start of the text)
+    starts = np.flatnonzero(~is_space & np.concatenate(([True], is_space[:-1])))
+    line_of_byte = np.cumsum(buffer == ord('\n'))
+    tokens_per_line = np.bincount(line_of_byte[starts], minlength=line_of_byte[-1] + 1)
+    return data.split(), tokens_per_line
+
+def parse_label_files(datas, task='detect', kpt_shape=None, class_ids=None, file_names=None, max_errors=MAX_REPORTED_LABEL_ERRORS):
+    """Parses the contents of YOLO label files into NumPy arrays in one vectorized pass
+
+    Rows are validated against the expected number of coordinates for the task, the [0, 1]
+    coordinate range, the largest class id that can be stored and, when class_ids is given, the
+    known class ids. Detect rows may also be polygons, like Ultralytics accepts them. file_names
+    are used in the error messages; the text of a row is only decoded when it is one of the first
+    max_errors invalid rows"""
+
+    datas = [file_data if file_data.endswith(b'\n') else file_data + b'\n' for file_data in datas]
+    data = b''.join(datas)
+    tokens, tokens_per_line = split_rows(data)
+
+    # rows of every file = its non-empty lines
+    line_counts = [file_data.count(b'\n') for file_data in datas]
+    file_of_line = np.repeat(np.arange(len(datas)), line_counts)
+    tokens_per_line = tokens_per_line[:len(file_of_line)]
+    row_lengths = tokens_per_line[tokens_per_line > 0]
+    file_of_row = file_of_line[tokens_per_line > 0]
+    line_of_row = np.flatnonzero(tokens_per_line > 0)
+
+    try:
+        numbers = np.array(tokens, dtype=np.float64)
+    except ValueError:
+        numbers = np.array([parse_number(token) for token in tokens], dtype=np.float64)
+
+    # the first token of a row is its class id, the rest are its coordinates
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    classes = numbers[row_starts]
+    is_class_position = np.zeros(len(numbers), dtype=bool)
+    is_class_position[row_starts] = True
+    values = numbers[~is_class_position]
+    value_lengths = row_lengths - 1
+    value_starts = row_starts - np.arange(len(row_starts))
+    row_of_value = np.repeat(np.arange(len(row_lengths)), value_lengths)
+    column_of_value = np.arange(len(values)) - value_starts[row_of_value]
+
+    # validate all rows at once, each check gives one flag per row
+    checks = []
+    class_is_int = np.isfinite(classes) & (classes == np.floor(classes)) & (classes >= 0)
+    checks.append((~class_is_int, "invalid class id"))
+    checks.append((class_is_int & (classes > MAX_CLASS_ID), f"class id above {MAX_CLASS_ID}"))
+    if class_ids is not None:
+        known = np.isin(classes, np.array(sorted(class_ids), dtype=np.float64))
+        checks.append((class_is_int & ~known, "class id not in names"))
+
+    expected = coordinate_count(task, kpt_shape)
+    bad_polygon = (value_lengths < 6) | (value_lengths % 2 == 1)
+    if expected is None:
+        bad_length = bad_polygon
+    elif task == 'detect':
+        bad_length = (value_lengths != expected) & bad_polygon
+    else:
+        bad_length = value_lengths != expected
+    checks.append((bad_length, "wrong number of coordinates"))
+
+    is_coordinate = np.ones(len(values), dtype=bool)
+    if task == 'pose':
+        mask = coordinate_mask(task, kpt_shape)
+        in_row = column_of_value < expected
+        is_coordinate[in_row] = mask[column_of_value[in_row]]
+    out_of_range = is_coordinate & ~((values >= 0) & (values <= 1))
+    bad_range = np.zeros(len(row_lengths), dtype=bool)
+    bad_range[row_of_value[out_of_range]] = True
+    checks.append((bad_range & ~bad_length, "coordinates out of range"))
+
+    invalid = np.zeros(len(row_lengths), dtype=bool)
+    errors = []
+    newlines = None
+    for (failed, message) in checks:
+        reported = np.flatnonzero(failed & ~invalid)[:max(max_errors - len(errors), 0)]
+        if len(reported) and newlines is None:
+            newlines = line_breaks(data)
+        for row in reported:
+            file_name = file_names[file_of_row[row]] if file_names is not None else file_of_row[row]
+            errors.append(f"{file_name}: {message}: {line_text(data, newlines, line_of_row[row]).decode(errors='replace')}")
+        invalid |= failed
+
+    valid = ~invalid
+    keep_values = np.repeat(valid, value_lengths)
+    offsets = np.concatenate(([0], np.cumsum(value_lengths[valid]))).astype(np.int64)
+    file_rows = np.concatenate(([0], np.cumsum(np.bincount(file_of_row[valid], minlength=len(datas))))).astype(np.int64)
+
+    return ParsedLabels(
+        classes[valid].astype(np.int64),
+        values[keep_values].astype(np.float32),
+        offsets,
+        file_rows,
+        errors,
+        int(invalid.sum()),
+    )
+
+def line_breaks(data):
+    """Gets the offsets of the line breaks of label text"""
+
+    return np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+
+def line_text(data, newlines, line):
+    """Gets the stripped text of one line of label text, newlines holds the offsets of its line breaks"""
+
+    start = newlines[line - 1] + 1 if line > 0 else 0
+    return data[start:newlines[line]].strip()
+
+def parse_label_file(data, task='detect', kpt_shape=None, class_ids=None):
+    """Parses the contents of one YOLO label file, see parse_label_files()"""
+
+    return parse_label_files([data], task, kpt_shape, class_ids)
+
+def parse_number(token):
+    """Converts one label token to a number, NaN when it is not a number (fails validation later)"""
+
+    try:
+        return float(token)
+    except ValueError:
+        return float('nan')
+
+# compact label storage: one dataset_labels document per image holding packed arrays
+DecodedLabels = namedtuple('DecodedLabels', ['class_ids', 'values', 'offsets'])
+
+def encode_labels(class_ids, values, offsets):
+    """Packs the label rows of one image into dataset_labels fields
+
+    class_ids are stored as uint16, coordinates as float32 and row offsets as uint32;
+    the distinct class ids and their row counts are kept as plain arrays for filtering"""
+
+    class_ids = np.asarray(class_ids, dtype=np.int64)
+    if len(class_ids) and (class_ids.min() < 0 or class_ids.max() > MAX_CLASS_ID):
+        raise ValueError(f"Class ids must be between 0 and {MAX_CLASS_ID}")
+    class_ids = class_ids.astype(np.uint16)
+    (distinct_class_ids, class_counts) = np.unique(class_ids, return_counts=True)
+    return {
+        'class_ids': distinct_class_ids.tolist(),
+        'class_counts': class_counts.tolist(),
+        'label_count': len(class_ids),
+        'classes': Binary(class_ids.tobytes()),
+        'coordinates': Binary(np.asarray(values, dtype=np.float32).tobytes()),
+        'offsets': Binary(np.asarray(offsets, dtype=np.uint32).tobytes()),
+    }
+
+def decode_labels(label_doc):
+    """Unpacks the label rows of a dataset_labels document"""
+
+    return DecodedLabels(
+        np.frombuffer(label_doc['classes'], dtype=np.uint16),
+        np.frombuffer(label_doc['coordinates'], dtype=np.float32),
+        np.frombuffer(label_doc['offsets'], dtype=np.uint32),
+    )
+
+def label_lines(label_doc):
+    """Rebuilds the YOLO label lines of a dataset_labels document as (class id, line) tuples"""
+
+    decoded = decode_labels(label_doc)
+    lines = []
+    for row, class_id in enumerate(decoded.class_ids.tolist()):
+        values = decoded.values[decoded.offsets[row]:decoded.offsets[row + 1]]
+        lines.append((class_id, ' '.join([str(class_id)] + ['%.6g' % value for value in values.tolist()])))
+    return lines
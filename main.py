@@ -1,39 +1,100 @@
 import os
+import json
+import mimetypes
+import hashlib
 import re
 import datetime
-import certifi
 import uuid
+import click
 
-from flask import Flask, render_template, request
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+from flask import Flask, Response, abort, jsonify, make_response, redirect, render_template, request, send_file, stream_with_context, url_for
 from config import *
 from helpers import *
+from analytics import MAX_OBJECTS_BIN, compute_analytics, get_analytics, get_dataset_analytics
+from class_index import backfill_class_index
+from chunked_uploads import UploadError, complete_upload, create_upload, expire_uploads, get_upload, upload_status, write_chunk
+from db import get_db, ping
+from export import export_filename, export_ndjson, export_zip
+from indexes import check_query_plans, ensure_indexes
+from jobs import get_job, resume_ingest_job, run_ingest_job, submit_ingest_job
+from metrics import instrument_app, render as render_metrics
+from settings import setting
+from storage_backends import LocalBackend
 
 app = Flask(__name__)
+# let the front server (Apache, lighttpd) send media files named in an X-Sendfile header
+app.config['USE_X_SENDFILE'] = setting('use_x_sendfile', False)
+instrument_app(app)
 
-client = MongoClient(mongodb_uri, server_api=ServerApi('1'), tlsCAFile=certifi.where())
+MAX_IMAGES_PAGE_SIZE = 200
+TASKS = ['classify', 'detect', 'obb', 'segment', 'pose']
+ANALYTICS_VIEW_CLASSES = setting('analytics_view_classes', 20)
+DATASETS_PAGE_TTL = setting('datasets_page_ttl', 30)
+MEDIA_MAX_AGE = setting('media_max_age', 365 * 24 * 3600)
+X_ACCEL_REDIRECT_PREFIX = setting('x_accel_redirect_prefix', None)
 
-# Send a ping to confirm a successful connection
-try:
-    client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(e)
+def cached_response(key, render, ttl=None, mimetype='text/html'):
+    """Serves a rendered page from the page cache, answering conditional GETs with 304 Not Modified
 
-db = client['yolo_datasets']
-datasets_table = db['datasets']
+    Pages are only cached when key is not None"""
+
+    page = page_cache.get(key) if key is not None else None
+    if page is None:
+        body = render()
+        etag = hashlib.sha1(body.encode()).hexdigest()
+        last_modified = datetime.datetime.now(datetime.UTC).replace(microsecond=0)
+        page = (body, etag, last_modified)
+        if key is not None:
+            page_cache.set(key, page, ttl)
+
+    (body, etag, last_modified) = page
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
 
 @app.route("/", methods=["GET"])
 def datasets():
 
-    # Get list of datasets
-    datasets = get_datasets()
-    classes = get_class_counts()
-    images = get_image_counts()
-    datasets_info = build_datasets_info(datasets, classes, images)
+    def render():
+        # Get list of datasets
+        datasets = get_datasets()
+        datasets_info = build_datasets_info(datasets)
+
+        return render_template("datasets.html", datasets_info=datasets_info)
+
+    # other instances do not see new uploads invalidating the list, so it is only kept briefly
+    return cached_response(('datasets',), render, DATASETS_PAGE_TTL)
+
+def get_page_args():
+    """Gets image set, class filter and keyset pagination arguments of an images request, raises ValueError for a class that is not an id"""
+
+    image_set = request.args.get('set')
+    if image_set is None:
+        image_set = "train"
 
-    return render_template("datasets.html", datasets_info=datasets_info)
+    class_id = request.args.get('class')
+    if class_id is None:
+        class_id = ""
+    if class_id and not class_id.isdecimal():
+        raise ValueError("Invalid class id: " + class_id)
+
+    after = request.args.get('after')
+    if after is None:
+        after = ""
+
+    limit = request.args.get('limit', IMAGES_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_IMAGES_PAGE_SIZE)
+
+    return image_set, class_id, after, limit
+
+def get_class_query_args():
+    """Gets the comma separated class ids or names of the all, any and none arguments of an images request"""
+
+    return request.args.get('all', ''), request.args.get('any', ''), request.args.get('none', '')
 
 @app.route("/images.html", methods=["GET"])
 def images():
@@ -42,26 +103,148 @@ def images():
 
     if dataset_id is not None:
         dataset_info = get_dataset_info(dataset_id)
+        query_args = get_class_query_args()
+        try:
+            image_set, class_id, after, limit = get_page_args()
+            query = parse_class_query(dataset_id, *query_args)
+        except ValueError as error:
+            return str(error), 400
+        if not query.is_empty() and not dataset_info.get('ingested'):
+            # the class index is built once the ingest has finished
+            return redirect(url_for('images', id=dataset_id, set=image_set))
 
-        image_set = request.args.get('set')
-        if image_set is None:
-            image_set = "train"
+        def render():
+            classes_counts = get_classes_counts(dataset_id, image_set)
+            count = None
+            if query.is_empty():
+                images_with_labels, next_after = get_images_with_labels_page(dataset_id, image_set, class_id, after, limit)
+            else:
+                images_with_labels, next_after, count = get_images_with_labels_query_page(dataset_id, image_set, query, after, limit)
+            return render_template("images.html", dataset_info=dataset_info, image_set=image_set, class_id=class_id, query_args=query_args, count=count, classes_counts=classes_counts, images_with_labels=images_with_labels, after=after, next_after=next_after, limit=limit)
 
-        class_id = request.args.get('class')
-        if class_id is None:
-            class_id = ""
+        # pages of a dataset are only cached once its ingest has finished
+        key = None
+        if dataset_info.get('ingested'):
+            key = (dataset_id, 'images.html', image_set, class_id, query.key(), after, limit)
+        return cached_response(key, render)
 
-        classes = get_classes(dataset_id)
-        labels = get_label_counts(dataset_id, image_set)
-        classes_counts = build_classes_counts(classes, labels)
+    return datasets()
 
-        images = get_images(dataset_id, image_set)
-        image_labels = get_labels(dataset_id, image_set)
-        class_names = get_class_names(dataset_id)
-        images_with_labels = build_images_with_labels(images, image_labels, class_id, class_names)
-        return render_template("images.html", dataset_info=dataset_info, image_set=image_set, class_id=class_id, classes_counts=classes_counts, images_with_labels=images_with_labels)
+@app.route("/api/images", methods=["GET"])
+def images_api():
 
-    return datasets()
+    dataset_id = request.args.get('id')
+    if dataset_id is None:
+        return jsonify({'error': 'Missing dataset id'}), 400
+
+    # Get one page of images with labels as JSON, all/any/none filter by several classes and add the number of matching images
+    try:
+        image_set, class_id, after, limit = get_page_args()
+        query = parse_class_query(dataset_id, *get_class_query_args())
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    if not query.is_empty() and not is_ingested(dataset_id):
+        return jsonify({'error': 'Dataset is still being ingested'}), 409
+
+    def render():
+        count = None
+        if query.is_empty():
+            images_with_labels, next_after = get_images_with_labels_page(dataset_id, image_set, class_id, after, limit)
+        else:
+            images_with_labels, next_after, count = get_images_with_labels_query_page(dataset_id, image_set, query, after, limit)
+
+        images = []
+        for image in images_with_labels:
+            images.append({
+                'image_set': image['image_set'],
+                'image_name': image['image_name'],
+                'image_url': image['image_url'],
+                'thumbnail_url': image.get('thumbnail_url'),
+                'preview_url': image.get('preview_url'),
+                'classes': sorted(image['labels']),
+                'label_names': image['label_names'],
+                'label_data': label_data(image),
+            })
+
+        page = {'images': images, 'next_after': next_after, 'limit': limit}
+        if count is not None:
+            page['count'] = count
+        return json.dumps(page)
+
+    key = None
+    if is_ingested(dataset_id):
+        key = (dataset_id, 'api/images', image_set, class_id, query.key(), after, limit)
+    return cached_response(key, render, mimetype='application/json')
+
+@app.route("/analytics.html", methods=["GET"])
+def analytics_view():
+
+    dataset_id = request.args.get('id')
+    if dataset_id is None:
+        return datasets()
+    dataset_info = get_dataset_info(dataset_id)
+    if not dataset_info.get('ingested'):
+        # analytics are computed once the ingest has finished
+        return redirect(url_for('images', id=dataset_id))
+    if get_analytics(dataset_id) is None:
+        # analytics are computed by the ingest job, or by recompute-analytics for datasets ingested before them
+        return "Analytics of this dataset are pending, they are computed after its ingest or by `flask --app main recompute-analytics " + dataset_id + "`", 409
+    image_set = request.args.get('set', 'train')
+
+    def render():
+        # the matrix grows with the square of the classes, the view only shows the most frequent ones
+        result = get_dataset_analytics(dataset_id, image_set, ANALYTICS_VIEW_CLASSES)
+        analytics = result['analytics']
+        objects_per_image = []
+        if analytics is not None:
+            counts = analytics['objects_per_image']['counts']
+            objects_per_image = [(str(objects) + ('+' if objects == MAX_OBJECTS_BIN else ''), count) for objects, count in enumerate(counts) if count > 0]
+        return render_template("analytics.html", dataset_info=dataset_info, image_set=image_set, analytics=analytics, split_balance=result['split_balance'], computed_time=result['computed_time'], objects_per_image=objects_per_image)
+
+    return cached_response((dataset_id, 'analytics.html', image_set), render)
+
+@app.route("/api/analytics", methods=["GET"])
+def analytics_api():
+
+    # Get box size histograms, objects per image, class co-occurrence and split balance of an image set as JSON
+    dataset_id = request.args.get('id')
+    if dataset_id is None:
+        return jsonify({'error': 'Missing dataset id'}), 400
+    dataset_info = get_dataset_info(dataset_id)
+    if not dataset_info:
+        return jsonify({'error': 'Dataset not found'}), 404
+    if not dataset_info.get('ingested'):
+        return jsonify({'error': 'Dataset is still being ingested'}), 409
+    if get_analytics(dataset_id) is None:
+        return jsonify({'error': 'Analytics are pending'}), 409
+    image_set = request.args.get('set', 'train')
+
+    return cached_response((dataset_id, 'api/analytics', image_set), lambda: json.dumps(get_dataset_analytics(dataset_id, image_set)), mimetype='application/json')
+
+@app.route("/api/export", methods=["GET"])
+def export_api():
+
+    # Stream an ingested dataset back as a YOLO layout zip, or its labels as NDJSON with format=ndjson
+    dataset_id = request.args.get('id')
+    if dataset_id is None:
+        return jsonify({'error': 'Missing dataset id'}), 400
+    dataset_info = get_dataset_info(dataset_id)
+    if not dataset_info:
+        return jsonify({'error': 'Dataset not found'}), 404
+    if not dataset_info.get('ingested'):
+        return jsonify({'error': 'Dataset is still being ingested'}), 409
+
+    export_format = request.args.get('format', 'zip')
+    if export_format == 'zip':
+        (chunks, mimetype, extension) = (export_zip(dataset_id), 'application/zip', '.zip')
+    elif export_format == 'ndjson':
+        (chunks, mimetype, extension) = (export_ndjson(dataset_id), 'application/x-ndjson', '.ndjson')
+    else:
+        return jsonify({'error': 'format must be zip or ndjson'}), 400
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="' + export_filename(dataset_info, extension) + '"'
+    return response
 
 @app.route("/upload.html", methods=["GET", "POST"])
 def upload():
@@ -72,23 +255,31 @@ def upload():
    
     # For POST request: Get data of dataset from form and add to MongoDB
     # also unzip + parse the contents and add them to the relevant collections
-    # Create empty Python dictionary to hold details of the dataset
-    dataset_upload = {}
-
     # Get dataset information from user form submission
     task = request.form.get("task")
     name = request.form.get("name")
     description = request.form.get("description")
 
+    # upload file
+    tmpfilename = str(uuid.uuid4()) + '.zip'
+    request.files['file'].save(tempdir + tmpfilename)
+
+    (dataset_id, job_id) = create_dataset(task, name, description, tempdir + tmpfilename)
+
+    # Return confirmation message after dataset submission 
+    return render_template("imported.html", job_id=job_id)
+
+def create_dataset(task, name, description, filename):
+    """Adds the entry of an uploaded dataset and starts its ingest job, returns the dataset and job ids"""
+
+    # Create empty Python dictionary to hold details of the dataset
+    dataset_upload = {}
+
     # Get date that user submitted the form
     # Attribution: Found this way to convert time of form submission here: https://www.programiz.com/python-programming/datetime/current-datetime
     upload_time = datetime.datetime.now(datetime.UTC)
     upload_time = upload_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-
-    # upload file
-    tmpfilename = str(uuid.uuid4()) + '.zip'
-    request.files['file'].save(tempdir + tmpfilename)
-    file_length = os.stat(tempdir + tmpfilename).st_size
+    file_length = os.stat(filename).st_size
 
     # Compile upload details into Python dictionary
     dataset_upload["task"] = task
@@ -97,16 +288,235 @@ def upload():
     dataset_upload["upload_time"] = upload_time
     dataset_upload["size"] = file_length
     dataset_upload["yaml_extra_data"] = ""
+    dataset_upload["ingested"] = False
     
     # Add dataset to MongoDB Atlas database
-    dataset_entry = datasets_table.insert_one(dataset_upload)
+    dataset_entry = get_db()['datasets'].insert_one(dataset_upload)
     dataset_id = str(dataset_entry.inserted_id)
+    page_cache.invalidate_prefix(('datasets',))
 
-    # process classes, images, labels
-    process_zip_file(tempdir + tmpfilename, dataset_id, task)
+    # process classes, images, labels in the background
+    job_id = submit_ingest_job(filename, dataset_id, task)
 
-    # Return confirmation message after dataset submission 
-    return render_template("imported.html")
+    return dataset_id, job_id
+
+@app.route("/media/<path:key>", methods=["GET"])
+def media(key):
+
+    # Serve a blob of the local storage backend with Range, conditional GET and long-lived cache headers;
+    # blobs are stored under content-addressed keys and never change, so clients may cache them for good
+    backend = get_storage_backend()
+    if not isinstance(backend, LocalBackend):
+        abort(404)
+    try:
+        path = backend.path(key)
+    except ValueError:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+
+    if X_ACCEL_REDIRECT_PREFIX is not None:
+        # nginx sends the file from its internal location, ranges and conditional requests included
+        response = make_response("")
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + key
+        response.mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    else:
+        # without X-Sendfile the file object is handed to the WSGI server, which sends it with sendfile()
+        response = send_file(path, conditional=True, etag=True, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/uploads", methods=["POST"])
+def start_upload():
+
+    # Start a chunked upload: the client sends the archive size and dataset details,
+    # then PUTs numbered chunks and completes the upload with a manifest of chunk checksums
+    data = request.get_json(silent=True) or {}
+    if data.get("task") not in TASKS or not data.get("name"):
+        return jsonify({'error': 'name and a valid task are required'}), 400
+    try:
+        upload = create_upload(int(data.get("size", 0)), int(data["chunk_size"]) if data.get("chunk_size") else None, task=data["task"], name=data["name"], description=data.get("description", ""))
+    except (UploadError, ValueError) as error:
+        return jsonify({'error': str(error)}), 400
+
+    return jsonify(upload_status(upload)), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_progress(upload_id):
+
+    # Get received and missing chunks, used by clients to resume after a disconnect
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    return jsonify(upload_status(upload))
+
+@app.route("/uploads/<upload_id>/chunks/<int:chunk>", methods=["PUT"])
+def upload_chunk(upload_id, chunk):
+
+    # Write one chunk at its offset in the archive as it is received, the X-Chunk-SHA256 header holds its checksum
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    checksum = request.headers.get("X-Chunk-SHA256")
+    if not checksum:
+        return jsonify({'error': 'X-Chunk-SHA256 header is required'}), 400
+    try:
+        upload = write_chunk(upload, chunk, request.stream, checksum, request.content_length)
+    except UploadError as error:
+        return jsonify({'error': str(error)}), 400
+
+    return jsonify(upload_status(upload))
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+def finish_upload(upload_id):
+
+    # Check the manifest and start ingesting the complete archive
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    try:
+        complete_upload(upload, request.get_json(silent=True))
+    except UploadError as error:
+        return jsonify({'error': str(error)}), 400
+
+    fields = upload['fields']
+    (dataset_id, job_id) = create_dataset(fields['task'], fields['name'], fields['description'], upload['filename'])
+    get_db()['uploads'].update_one({'_id': upload['_id']}, {'$set': {'dataset_id': dataset_id, 'job_id': job_id}})
+
+    return jsonify({'dataset_id': dataset_id, 'job_id': job_id})
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+
+    # Get phase, progress counts, throughput and errors of an ingest job
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify(job)
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+
+    # Liveness: the process serves requests, MongoDB is not contacted
+    return jsonify({'status': 'ok'})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+
+    # Readiness: MongoDB answers a ping, connecting the shared client on first use
+    try:
+        ping()
+    except Exception as error:
+        return jsonify({'status': 'unavailable', 'error': str(error)}), 503
+
+    return jsonify({'status': 'ready'})
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+
+    # Request, query and ingest stage histograms of this process in the Prometheus text format
+    response = make_response(render_metrics())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.cli.command("recompute-stats")
+@click.argument("dataset_id", required=False)
+def recompute_stats(dataset_id):
+    """Recounts classes, images and labels stored on dataset entries to repair drift"""
+
+    count = recompute_dataset_stats(dataset_id)
+    print(f"Recomputed stats of {count} datasets")
+
+@app.cli.command("recompute-analytics")
+@click.argument("dataset_id", required=False)
+def recompute_analytics_command(dataset_id):
+    """Computes the label analytics of ingested datasets again, e.g. after their labels were converted"""
+
+    if dataset_id is None:
+        dataset_ids = [str(dataset['_id']) for dataset in get_datasets() if is_ingested(str(dataset['_id']))]
+    else:
+        dataset_ids = [dataset_id]
+
+    for dataset_id in dataset_ids:
+        analytics = compute_analytics(dataset_id)
+        print(dataset_id, sum(split['labels'] for split in analytics['image_sets'].values()), "labels")
+        invalidate_dataset_caches(dataset_id)
+
+@app.cli.command("compact-labels")
+@click.argument("dataset_id", required=False)
+def compact_labels_command(dataset_id):
+    """Converts labels stored one document per label line to packed per-image documents"""
+
+    if dataset_id is None:
+        dataset_ids = [str(dataset['_id']) for dataset in get_datasets()]
+    else:
+        dataset_ids = [dataset_id]
+
+    for dataset_id in dataset_ids:
+        print(dataset_id, compact_dataset_labels(dataset_id), "images")
+
+@app.cli.command("build-class-index")
+@click.argument("dataset_id", required=False)
+def build_class_index_command(dataset_id):
+    """Builds the class index of ingested datasets that do not have one, their queries use MongoDB filters until then"""
+
+    if dataset_id is None:
+        dataset_ids = [str(dataset['_id']) for dataset in get_datasets() if 'class_index' not in dataset and is_ingested(str(dataset['_id']))]
+    else:
+        dataset_ids = [dataset_id]
+
+    for dataset_id in dataset_ids:
+        class_index = backfill_class_index(dataset_id)
+        if class_index is None:
+            print(dataset_id, "already has a class index or is being built by another process")
+        else:
+            print(dataset_id, class_index['image_sets'])
+            invalidate_dataset_caches(dataset_id)
+
+@app.cli.command("resume-ingest")
+@click.argument("dataset_id")
+@click.option("--force", is_flag=True, help="Also resume a queued or running job, when the process running it has crashed")
+def resume_ingest_command(dataset_id, force):
+    """Continues the failed (or interrupted) ingest of a dataset from its last checkpoint"""
+
+    resumed = resume_ingest_job(dataset_id, force)
+    if resumed is None:
+        raise click.ClickException(f"No failed ingest with a kept archive for dataset {dataset_id}")
+    (job_id, filename, task) = resumed
+    print(f"Resuming ingest of {dataset_id} as job {job_id}")
+    status = run_ingest_job(job_id, filename, dataset_id, task)
+    print(status)
+    if status != 'done':
+        raise click.ClickException(f"Ingest of dataset {dataset_id} failed again, see /jobs/{job_id}")
+
+@app.cli.command("expire-uploads")
+@click.option("--max-age", type=int, default=None, help="Seconds after which an unfinished upload expires, upload_max_age by default")
+def expire_uploads_command(max_age):
+    """Deletes the chunked uploads that were started but not completed in time, with their temp files"""
+
+    count = expire_uploads() if max_age is None else expire_uploads(max_age)
+    print(f"Deleted {count} expired uploads")
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Creates the indexes used by the query helpers, safe to run repeatedly"""
+
+    for collection_name, index_names in ensure_indexes().items():
+        print(collection_name, ', '.join(index_names))
+
+@app.cli.command("check-indexes")
+@click.argument("dataset_id", required=False)
+def check_indexes_command(dataset_id):
+    """Fails if the plan of any query helper uses a collection scan or an in-memory sort"""
+
+    failures = check_query_plans(dataset_id=dataset_id)
+    if failures:
+        raise click.ClickException(f"{len(failures)} queries are not served by an index")
 
 if __name__ == "__main__":
     app.run(port=8000)
@@ -0,0 +1,248 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from settings import setting
+
+PROFILE_SAMPLE_RATE = setting('profile_sample_rate', 0.0)
+PROFILE_DIR = setting('profile_dir', None)
+
+# seconds, from a fast indexed query to a slow page render
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# bytes, from a label file to a large image
+SIZE_BUCKETS = [1024 * 4 ** i for i in range(11)]
+
+_metrics = {}
+_lock = threading.Lock()
+_first_response = threading.Event()
+
+def process_start_time():
+    """Gets the wall clock time the current process started, including interpreter startup on Linux"""
+
+    try:
+        with open('/proc/self/stat') as f:
+            # the start time is field 22, counted after the parenthesized command name
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+PROCESS_START_TIME = process_start_time()
+
+class Counter:
+    """Prometheus counter with labels"""
+
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        """Adds to the counter of a label set"""
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(key), value) for key, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    """Prometheus gauge with labels"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        """Sets the value of a label set"""
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+class Histogram:
+    """Prometheus histogram with labels, counting observations in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Records one observation for a label set"""
+
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, entry in sorted(self.values.items()):
+                labels = dict(key)
+                for bound, count in zip(self.buckets, entry['buckets']):
+                    samples.append((self.name + '_bucket', {**labels, 'le': repr(float(bound))}, count))
+                samples.append((self.name + '_bucket', {**labels, 'le': '+Inf'}, entry['count']))
+                samples.append((self.name + '_sum', labels, entry['sum']))
+                samples.append((self.name + '_count', labels, entry['count']))
+        return samples
+
+def register(metric):
+    """Adds a metric to the registry, or gets the one already registered under its name"""
+
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+def counter(name, help):
+    """Gets the counter registered under a name, creating it on first use"""
+
+    return register(Counter(name, help))
+
+def gauge(name, help):
+    """Gets the gauge registered under a name, creating it on first use"""
+
+    return register(Gauge(name, help))
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    """Gets the histogram registered under a name, creating it on first use"""
+
+    return register(Histogram(name, help, buckets))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+def render():
+    """Gets all registered metrics in the Prometheus text exposition format"""
+
+    lines = []
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for (name, labels, value) in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds', "Time spent handling HTTP requests")
+RESPONSE_BYTES = histogram('http_response_size_bytes', "Size of HTTP response bodies", SIZE_BUCKETS)
+QUERY_SECONDS = histogram('mongo_query_duration_seconds', "Time spent in MongoDB query helpers")
+STAGE_SECONDS = histogram('ingest_stage_duration_seconds', "Time spent in each ingest stage, per batch or file")
+STAGE_ITEMS = counter('ingest_stage_items_total', "Files, rows or documents handled by each ingest stage")
+STAGE_BYTES = counter('ingest_stage_bytes_total', "Bytes read or written by each ingest stage")
+FIRST_RESPONSE_SECONDS = gauge('process_first_response_seconds', "Time from process start to the first response (cold start)")
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observes the time spent in a with block on a histogram"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+def timed_query(function):
+    """Decorates a MongoDB helper to observe its duration, labelled with the helper name"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timer(QUERY_SECONDS, query=function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+@contextmanager
+def ingest_stage(stage):
+    """Times one run of an ingest stage, the with block sets the 'items' and 'bytes' it handled on the yielded dict"""
+
+    counts = {'items': 0, 'bytes': 0}
+    start = time.perf_counter()
+    yield counts
+    record_stage(stage, time.perf_counter() - start, counts['items'], counts['bytes'])
+
+def record_stage(stage, seconds, items, bytes):
+    """Records one run of an ingest stage timed elsewhere, e.g. in a worker process"""
+
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    STAGE_ITEMS.inc(items, stage=stage)
+    STAGE_BYTES.inc(bytes, stage=stage)
+
+def instrument_app(app):
+    """Records duration and response size of every request of a Flask app, profiling a sample of them
+
+    The time from process start to the first response is recorded as the cold start time. With
+    profile_sample_rate above 0 that share of requests runs under cProfile; the profile is printed
+    and, when profile_dir is set, saved there for pstats or snakeviz"""
+
+    from flask import g, request
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        g.profiler = None
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError: # another request of this process is being profiled
+                return
+            g.profiler = profiler
+
+    @app.after_request
+    def record_request_metrics(response):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+        REQUEST_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+        if response.content_length is not None:
+            RESPONSE_BYTES.observe(response.content_length, route=route)
+        if not _first_response.is_set():
+            _first_response.set()
+            cold_start = time.time() - PROCESS_START_TIME
+            FIRST_RESPONSE_SECONDS.set(cold_start)
+            print(f"First response {cold_start:.3f} s after process start")
+        profiler = g.get('profiler')
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, route, elapsed)
+        return response
+
+def save_profile(profiler, route, elapsed):
+    """Prints the slowest functions of a sampled request and saves its profile to PROFILE_DIR"""
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(15)
+    print(f"Profile of {route} ({elapsed * 1000:.1f} ms)")
+    print(output.getvalue())
+    if PROFILE_DIR is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'index'
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}-{time.time():.6f}.prof"))
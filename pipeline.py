@@ -0,0 +1,92 @@
+import multiprocessing
+import queue
+import threading
+import zipfile
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from settings import setting
+
+PIPELINE_QUEUE_SIZE = setting('pipeline_queue_size', 1000)
+
+# kinds of entries passed through a stage queue
+_ITEM = 0
+_END = 1
+_FAILED = 2
+
+# zip handles opened by the current worker process, by zip file name
+_archives = {}
+
+def threaded(items, maxsize=PIPELINE_QUEUE_SIZE, name='pipeline'):
+    """Runs a generator stage in a background thread and yields its items through a bounded queue
+
+    The stage blocks once maxsize items are waiting, so it runs ahead of its consumer by at most
+    that many items; an error raised by the stage is raised again in the consuming thread"""
+
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((_ITEM, item)):
+                    return
+            put((_END, None))
+        except BaseException as error:
+            put((_FAILED, error))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (kind, value) = buffer.get()
+            if kind == _END:
+                return
+            if kind == _FAILED:
+                raise value
+            yield value
+    finally:
+        # stops the stage when the consumer finishes early or fails
+        stop.set()
+        thread.join()
+
+def process_pool(workers):
+    """Gets a process pool of workers started with spawn"""
+
+    # spawned workers do not inherit the locks held by the threads of the web process
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def worker_archive(zip_file_name):
+    """Gets the handle on a zip archive of the current worker process, opening it on first use"""
+
+    archive = _archives.get(zip_file_name)
+    if archive is None:
+        archive = zipfile.ZipFile(zip_file_name)
+        _archives[zip_file_name] = archive
+    return archive
+
+def ordered_map(executor, fn, items, max_in_flight):
+    """Runs fn on every item in an executor keeping up to max_in_flight running, yields the results in item order
+
+    The calls still running are cancelled when the consumer finishes early or fails"""
+
+    in_flight = deque()
+    try:
+        for item in items:
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(fn, item))
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -0,0 +1,99 @@
+import datetime
+import threading
+import time
+
+class NullProgress:
+    """Progress reporter that discards all updates, used when an ingest runs outside a job"""
+
+    def phase(self, name):
+        pass
+
+    def add(self, counter, n=1):
+        pass
+
+    def set(self, counter, value):
+        pass
+
+    def error(self, message):
+        pass
+
+    def flush(self):
+        pass
+
+class JobProgress(NullProgress):
+    """Records phase, progress counters, throughput and errors of an ingest job in MongoDB
+
+    Counter updates are written at most once per interval so progress reporting stays cheap"""
+
+    def __init__(self, collection, job_id, interval=1.0):
+        self.collection = collection
+        self.job_id = job_id
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.current_phase = None
+        self.phase_start = time.perf_counter()
+        self.counts = {}
+        self.phase_counts = {}
+        self.rated_counters = set()
+        self.throughput = {}
+        self.errors = []
+        self.last_flush = 0.0
+
+    def phase(self, name):
+        """Starts a new ingest phase"""
+
+        # record the final throughput of the phase that just ended
+        if self.current_phase is not None:
+            self.flush()
+        with self.lock:
+            self.current_phase = name
+            self.phase_start = time.perf_counter()
+            self.phase_counts = dict(self.counts)
+        self.flush()
+
+    def add(self, counter, n=1):
+        """Adds to a progress counter"""
+
+        with self.lock:
+            self.counts[counter] = self.counts.get(counter, 0) + n
+            self.rated_counters.add(counter)
+        self.maybe_flush()
+
+    def set(self, counter, value):
+        """Sets a progress counter, e.g. a total known up front"""
+
+        with self.lock:
+            self.counts[counter] = value
+        self.maybe_flush()
+
+    def error(self, message):
+        """Records an error message"""
+
+        with self.lock:
+            self.errors.append(message)
+        self.flush()
+
+    def maybe_flush(self):
+        if time.perf_counter() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the current progress to the job document"""
+
+        with self.lock:
+            elapsed = time.perf_counter() - self.phase_start
+            if elapsed > 0:
+                # throughput of the counters that moved during the current phase
+                for counter in self.rated_counters:
+                    done = self.counts[counter] - self.phase_counts.get(counter, 0)
+                    if done > 0:
+                        self.throughput[counter + '_per_second'] = round(done / elapsed, 1)
+            update = {
+                'phase': self.current_phase,
+                'counts': dict(self.counts),
+                'throughput': dict(self.throughput),
+                'errors': list(self.errors),
+                'updated_time': datetime.datetime.now(datetime.UTC),
+            }
+            self.last_flush = time.perf_counter()
+        self.collection.update_one({'_id': self.job_id}, {'$set': update})
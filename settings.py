@@ -0,0 +1,6 @@
+import config
+
+def setting(name, default):
+    """Gets an optional setting from config.py, falling back to a default value"""
+
+    return getattr(config, name, default)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+from config import *
+from settings import setting
+
+class GCSBackend:
+    """Stores blobs in a Google Cloud Storage bucket through one shared client"""
+
+    def __init__(self, bucket_name, base_url=None):
+        from google.cloud import storage
+
+        self.bucket_name = bucket_name
+        self.base_url = (base_url or "http://storage.googleapis.com/" + str(bucket_name)).rstrip('/')
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def upload(self, key, file_obj, size=None):
+        """Uploads a file object to the bucket under the given key"""
+
+        self.bucket.blob(key).upload_from_file(file_obj, size=size)
+
+    def open(self, key):
+        """Opens a blob of the bucket for reading, streaming it in chunks"""
+
+        return self.bucket.blob(key).open('rb')
+
+    def url(self, key):
+        """Gets the public URL of a blob"""
+
+        return self.base_url + "/" + key
+
+    def key(self, url):
+        """Gets the key of a blob from its URL, None when the URL is not in the bucket"""
+
+        for prefix in [self.url(""), "http://storage.googleapis.com/" + str(self.bucket_name) + "/"]:
+            if url.startswith(prefix):
+                return url[len(prefix):]
+        return None
+
+class LocalBackend:
+    """Stores blobs as files under a local directory"""
+
+    def __init__(self, root, base_url):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/')
+
+    def path(self, key):
+        """Gets the local path of a blob, rejecting keys that escape the storage directory"""
+
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError("Invalid blob key " + key)
+        return path
+
+    def upload(self, key, file_obj, size=None):
+        """Copies a file object to the storage directory under the given key"""
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(file_obj, f, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def open(self, key):
+        """Opens a stored blob for reading"""
+
+        return open(self.path(key), 'rb')
+
+    def url(self, key):
+        """Gets the URL a blob is served from"""
+
+        return self.base_url + "/" + key
+
+    def key(self, url):
+        """Gets the key of a blob from its URL, None when the URL is not served from the storage directory"""
+
+        prefix = self.url("")
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+_backend = None
+
+def get_storage_backend():
+    """Gets the storage backend selected in config.py, creating it on first use
+
+    media_base_url replaces the URL blobs are served from, e.g. with a CDN in front of the bucket;
+    image URLs are built from their keys when a page is rendered, so it applies to stored images too"""
+
+    global _backend
+    if _backend is None:
+        base_url = setting('media_base_url', None)
+        if setting('storage_backend', 'gcs') == 'local':
+            _backend = LocalBackend(setting('local_storage_dir', tempdir + 'media'), base_url or setting('local_storage_url', '/media'))
+        else:
+            _backend = GCSBackend(bucket_name, base_url)
+    return _backend
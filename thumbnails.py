@@ -0,0 +1,108 @@
+import hashlib
+import io
+import os
+
+from functools import partial
+from pipeline import ordered_map, process_pool, worker_archive
+from settings import setting
+
+MAKE_THUMBNAILS = setting('make_thumbnails', True)
+MAKE_PREVIEWS = setting('make_previews', False)
+THUMBNAIL_SIZE = setting('thumbnail_size', 320)
+PREVIEW_SIZE = setting('preview_size', 1280)
+THUMBNAIL_WORKERS = setting('thumbnail_workers', os.cpu_count() or 1)
+
+def image_key(digest, image_name):
+    """Gets the content-addressed storage key of an image, keeping its file extension"""
+
+    extension = os.path.splitext(image_name)[1].lower()
+    return "images/" + digest[:2] + "/" + digest + extension
+
+def thumbnail_key(key):
+    """Gets the storage key of the thumbnail of an image"""
+
+    return "thumbnails/" + key + ".jpg"
+
+def preview_key(key):
+    """Gets the storage key of the WebP preview of an image"""
+
+    return "previews/" + key + ".webp"
+
+def resize_image(image, size, format, quality):
+    """Encodes a copy of an image downscaled to fit in a size x size box"""
+
+    from PIL import Image
+
+    image = image.copy()
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format=format, quality=quality)
+    return output.getvalue()
+
+def make_image_variants(zip_file_name, member, thumbnails, previews):
+    """Hashes an image in the archive and creates its thumbnail and preview, run in a worker process
+
+    Returns the SHA-256 digest and size of the image, plus the thumbnail and preview bytes when
+    they were requested and the file can be read as an image"""
+
+    from PIL import Image
+
+    archive = worker_archive(zip_file_name)
+
+    # hash the image while it is decompressed, keeping the bytes for the thumbnail
+    digest = hashlib.sha256()
+    data = io.BytesIO()
+    size = 0
+    with archive.open(member, 'r') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+            if thumbnails:
+                data.write(chunk)
+    variants = {'sha256': digest.hexdigest(), 'size': size}
+    if not thumbnails:
+        return variants
+
+    try:
+        data.seek(0)
+        image = Image.open(data)
+        image.load()
+    except Exception as error:
+        print(f"Error - Cannot create thumbnail of {member}: {error}")
+        return variants
+
+    variants['thumbnail'] = resize_image(image, THUMBNAIL_SIZE, 'JPEG', 80)
+    if previews:
+        variants['preview'] = resize_image(image, PREVIEW_SIZE, 'WEBP', 80)
+    return variants
+
+class ThumbnailGenerator:
+    """Hashes the images in a zip archive and creates their thumbnails and previews in a process pool"""
+
+    def __init__(self, zip_file_name, workers=THUMBNAIL_WORKERS, thumbnails=MAKE_THUMBNAILS, previews=MAKE_PREVIEWS):
+        self.zip_file_name = zip_file_name
+        self.workers = workers
+        self.thumbnails = thumbnails
+        self.previews = previews and thumbnails
+        self.executor = process_pool(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def map(self, members, max_in_flight=None):
+        """Processes zip members keeping up to max_in_flight running, yields their digests and variants in member order"""
+
+        if max_in_flight is None:
+            max_in_flight = self.workers * 4
+        make_variants = partial(make_image_variants, self.zip_file_name, thumbnails=self.thumbnails, previews=self.previews)
+        return ordered_map(self.executor, make_variants, members, max_in_flight)
+
+    def close(self):
+        """Stops the worker processes"""
+
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,117 @@
+import io
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from metrics import ingest_stage
+from pipeline import ordered_map
+from settings import setting
+
+UPLOAD_WORKERS = setting('upload_workers', 8)
+UPLOAD_RETRIES = setting('upload_retries', 3)
+UPLOAD_RETRY_DELAY = setting('upload_retry_delay', 0.5)
+
+class ImageUploader:
+    """Uploads files from a zip archive to a storage backend using a bounded thread pool"""
+
+    def __init__(self, backend, zip_file_name, workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES):
+        self.backend = backend
+        self.zip_file_name = zip_file_name
+        self.workers = workers
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploader')
+        self.local = threading.local()
+        self.archives = []
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'retries': 0, 'seconds': 0.0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def archive(self):
+        """Gets the zip handle of the current worker thread, opening it on first use"""
+
+        archive = getattr(self.local, 'archive', None)
+        if archive is None:
+            archive = zipfile.ZipFile(self.zip_file_name)
+            self.local.archive = archive
+            with self.lock:
+                self.archives.append(archive)
+        return archive
+
+    def open_source(self, source):
+        """Opens a blob source, either the name of a zip member or bytes generated during ingest"""
+
+        if isinstance(source, bytes):
+            return io.BytesIO(source), len(source)
+        archive = self.archive()
+        return archive.open(source, 'r'), archive.getinfo(source).file_size
+
+    def upload(self, source, key):
+        """Uploads one blob, retrying with exponential backoff, and returns its URL
+
+        A source of None means the blob is already stored and only its URL is returned"""
+
+        if source is None:
+            return self.backend.url(key)
+        for attempt in range(self.retries + 1):
+            try:
+                with ingest_stage('upload') as stage:
+                    (f, size) = self.open_source(source)
+                    with f:
+                        self.backend.upload(key, f, size=size)
+                    stage['items'] = 1
+                    stage['bytes'] = size
+                break
+            except Exception as error:
+                if attempt == self.retries:
+                    raise
+                print(f"Upload of {key} failed ({error}), retrying")
+                with self.lock:
+                    self.stats['retries'] += 1
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['bytes'] += size
+        return self.backend.url(key)
+
+    def upload_all(self, blobs):
+        """Uploads the (source, key) blobs of one job and returns their URLs"""
+
+        return [self.upload(source, key) for (source, key) in blobs]
+
+    def map(self, jobs, max_in_flight=None):
+        """Uploads jobs, each a list of (source, key) blobs, keeping up to max_in_flight jobs running
+
+        Yields the list of blob URLs of every job in job order"""
+
+        if max_in_flight is None:
+            max_in_flight = self.workers * 2
+        start = time.perf_counter()
+        try:
+            yield from ordered_map(self.executor, self.upload_all, jobs, max_in_flight)
+        finally:
+            with self.lock:
+                self.stats['seconds'] += time.perf_counter() - start
+
+    def throughput(self):
+        """Gets upload counts, retries, files per second and bytes per second"""
+
+        report = dict(self.stats)
+        seconds = report['seconds']
+        report['files_per_second'] = round(report['files'] / seconds, 1) if seconds > 0 else 0.0
+        report['bytes_per_second'] = round(report['bytes'] / seconds, 1) if seconds > 0 else 0.0
+        return report
+
+    def close(self):
+        """Stops the worker threads and closes their zip handles"""
+
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for archive in self.archives:
+            archive.close()
+        self.archives = []